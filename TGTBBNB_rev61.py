@@ -1,23 +1,191 @@
 import time
 import logging
-import pandas as pd
-from binance.client import Client
-from ta.trend import SMAIndicator, EMAIndicator, MACD
-from ta.momentum import RSIIndicator
 from binance.exceptions import BinanceAPIException, BinanceOrderException
 from requests.exceptions import ConnectionError, Timeout
 import telegram
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, ConversationHandler
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import (Updater, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, Filters,
+                          ConversationHandler, DispatcherHandlerStop)
 import signal
 import sys
 import random
-import openai
+import threading
+import queue
+import math
+import heapq
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from decimal import Decimal, ROUND_DOWN
+import json
+import uuid
+import os
+import re
+import ast
+import operator
+import hashlib
+import io
+import hmac
+import bisect
+import tracemalloc
+import multiprocessing
+from multiprocessing.connection import Listener, Client as ConnectionClient
+from functools import reduce
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+# pandas, numpy, ta and openai are imported inside the functions that use them, so modes that never
+# need them do not pay for loading them at startup. binance.exceptions is imported normally: the
+# except clauses throughout need its classes, and importing it also loads the binance client
 
 # Setup logging
 logging.basicConfig(filename='trading_bot.log', level=logging.INFO, format='%(asctime)s %(message)s')
 
+# Trading parameters
+coins = [
+    'BTC', 'ETH', 'BNB', 'XRP', 'ADA', 'DOGE', 'SOL', 'DOT', 'MATIC', 'LTC',
+    'TRX', 'AVAX', 'LINK', 'XLM', 'ATOM', 'ETC', 'XMR', 'BCH', 'ALGO', 'VET',
+    'ICP', 'FIL', 'EOS', 'AAVE', 'MKR', 'NEO', 'KSM', 'ZEC', 'SUSHI', 'UNI',
+    'YFI', 'GRT', 'CHZ', 'SNX', '1INCH', 'RUNE', 'LRC', 'COMP', 'FTM', 'ENJ'
+]
+stable_coin = 'USDT'
+route_coin = 'BNB'  # Secondary hub for conversions without a direct market
+stop_loss_threshold = 0.05
+take_profit_threshold = 0.10
+trailing_stop_pct = 0.05  # Stop trails the high since entry by this fraction; None disables it
+atr_period = 14
+atr_stop_multiplier = 3.0  # Volatility stop sits this many ATRs below the high since entry
+atr_interval = '1h'
+max_retries = 5
+exchange_info_ttl = 3600  # Seconds between exchange info refreshes
+book_ticker_ttl = 5  # Seconds a bulk order book top snapshot stays valid
+max_impact_bps = 30  # Estimated slippage above which a market order is sliced
+max_cross_bps = 15  # Furthest a child limit order may be priced beyond the touch
+max_slices = 10
+slice_interval = 5  # Seconds between child orders of a sliced leg
+depth_limit = 100
+execution_workers = 16  # Shared by trade execution and webhook update handling
+rebalance_tolerance = 0.02  # Allocation drift (fraction of portfolio) tolerated before trading
+default_min_notional = 10.0
+breaker_threshold = 3  # Consecutive failures before a symbol, stage or endpoint is paused
+breaker_base_delay = 30  # Seconds of the first pause; doubles on every further failure
+breaker_max_delay = 900
+cycle_interval = 60
+shutdown_deadline = 60  # Seconds started trades get to finish their legs after SIGINT/SIGTERM
+
+# Retry policy per endpoint: total deadline in seconds, bounds of the jittered delay, and whether
+# a failed call can be repeated blindly (order placement cannot, unless Binance rejected it outright)
+RetryPolicy = namedtuple('RetryPolicy', ['attempts', 'deadline', 'base_delay', 'max_delay', 'idempotent'])
+retry_policies = {
+    'default': RetryPolicy(3, 2.0, 0.05, 0.5, True),
+    'klines': RetryPolicy(max_retries, 5.0, 0.1, 1.0, True),
+    'exchange_info': RetryPolicy(max_retries, 10.0, 0.2, 2.0, True),
+    'order': RetryPolicy(3, 3.0, 0.1, 1.0, False),
+}
+transient_error_codes = {-1001, -1003, -1007, -1021}  # Disconnected, rate limited, timeout, clock skew
+rejected_order_codes = {-1003, -1015, -1021}  # Order refused before reaching the matching engine
+server_time_refresh = 300  # Seconds between measurements of the offset to the exchange clock
+order_timeout = 3  # Seconds an order submission may take before its outcome is looked up instead
+order_reconcile_attempts = 3  # Lookups, and resubmissions of orders that never arrived, before giving up
+unknown_outcome_codes = {-1007}  # Order sent but its execution status is unknown
+final_order_statuses = {'FILLED', 'CANCELED', 'EXPIRED', 'REJECTED', 'EXPIRED_IN_MATCH'}
+
+# A local fake exchange can stand in for Binance by exporting TGTBBNB_API_URL (e.g.
+# http://127.0.0.1:8000/api) and TGTBBNB_USER_STREAM_URL (e.g. ws://127.0.0.1:8001/ws)
+rest_api_url = os.environ.get('TGTBBNB_API_URL')  # None uses Binance
+user_stream_url = os.environ.get('TGTBBNB_USER_STREAM_URL', 'wss://stream.binance.com:9443/ws')
+listen_key_keepalive = 1800  # Binance expires a listen key after 60 minutes without a keep-alive
+stream_reconnect_max_delay = 60
+market_stream_url = 'wss://stream.binance.com:9443/stream'
+base_interval = '1m'  # Only interval streamed; higher timeframes are aggregated from it in memory
+candle_history = 500  # Candles kept per symbol and timeframe
+confirmation_timeout = 600  # Seconds a trade confirmation prompt stays valid
+confirmation_price_tolerance = 0.01  # Largest price move since the prompt that an approval still accepts
+warm_state_file = 'trading_state_{chat_id}.json'  # Snapshot of caches and cost basis reloaded on restart
+warm_state_interval = 600  # Seconds between checkpoints, unless unresolved orders or open trades change
+warm_state_filters = ('LOT_SIZE', 'PRICE_FILTER', 'NOTIONAL', 'MIN_NOTIONAL')  # Symbol filters kept in it
+dynamic_universe = True  # Add the most traded pairs from exchange info and 24h volume to the coins list
+universe_min_quote_volume = 5000000  # Minimum 24h volume in stable_coin for a pair to be traded
+universe_max_size = 200
+universe_excluded_bases = {  # Stablecoins and fiat, which never trend against stable_coin
+    'USDT', 'USDC', 'FDUSD', 'TUSD', 'BUSD', 'USDP', 'DAI', 'USDE', 'USD1', 'PYUSD', 'AEUR', 'EURI',
+    'EUR', 'GBP', 'AUD', 'TRY', 'BRL', 'ARS', 'MXN', 'PLN', 'RON', 'UAH', 'ZAR', 'JPY', 'COP', 'CZK',
+}
+leveraged_token_suffixes = ('UP', 'DOWN', 'BULL', 'BEAR')
+universe_ttl = 3600
+prescreen_min_move = 0.005  # Price move since the last full evaluation that warrants a new one
+prescreen_max_age = 900  # Seconds after which a symbol is evaluated even if its price has not moved
+target_top_k = 10  # Best-scoring coins kept as rotation destinations each cycle
+min_target_score = 0.0  # Below this no coin is attractive and rotations go to stable_coin
+strategy_rules_file = 'strategy_rules.json'  # Optional {"action": "expression"} overrides, first match wins
+default_strategy_rules = {
+    'buy': 'sma_50 > sma_200 and rsi < 30 and macd > macd_signal',
+    'sell': 'rsi > 70 and macd < macd_signal',
+}
+score_indicators = {'sma_50', 'sma_200', 'macd', 'macd_signal', 'rsi', 'close'}  # Read by target ranking
+advisor_precision = 6  # Significant digits of the indicator values sent to ChatGPT
+supervisor_workers = os.cpu_count() or 2  # Worker processes started by --supervisor
+hash_ring_replicas = 64  # Virtual nodes per worker on the consistent hash ring
+market_hub_address = ('127.0.0.1', 47800)  # Local socket on which the supervisor publishes market data
+market_feed_max_age = 15  # Seconds a published market snapshot is trusted by workers
+worker_heartbeat_interval = 5
+worker_heartbeat_timeout = 20
+webhook_listen = ('0.0.0.0', 8443)
+webhook_url = 'https://your.domain/telegram'  # Public URL Telegram posts to, proxied to webhook_listen
+webhook_path = '/telegram'
+webhook_secret = os.environ.get('TGTBBNB_WEBHOOK_SECRET') or uuid.uuid4().hex
+webhook_max_pending = 1000  # Updates queued beyond this are refused with 429 so Telegram retries later
+operator_chat_ids = {int(i) for i in os.environ.get('TGTBBNB_OPERATOR_CHAT_IDS', '').split(',') if i}  # May run /profile and /memsnap
+profile_sample_interval = 0.005  # Seconds between stack samples taken by /profile
+profile_max_seconds = 300
+profile_top = 40  # Entries listed in /profile and /memsnap reports
+config_file = 'trading_config.json'  # Optional overrides of the settings below, reapplied whenever it changes
+reloadable_settings = {
+    'coins': 'coins', 'stable_coin': 'coin', 'route_coin': 'coin', 'stop_loss_threshold': 'fraction',
+    'take_profit_threshold': 'positive', 'trailing_stop_pct': 'fraction_or_none', 'atr_stop_multiplier': 'positive',
+    'max_retries': 'count', 'cycle_interval': 'positive', 'rebalance_tolerance': 'fraction',
+    'target_allocation': 'allocation',
+}
+paper_portfolios_file = 'paper_portfolios.json'  # [{"name", "mode", "balances", "rules"}] run by --paper
+paper_starting_balances = {stable_coin: 1000.0}
+paper_fee = 0.001  # Taker fee charged on simulated fills, in the asset received
+paper_market_ttl = {'get_klines': 30, 'get_exchange_info': exchange_info_ttl}  # Seconds shared responses are reused (klines: between top-ups); others book_ticker_ttl
+interval_ms = {
+    '1m': 60000, '3m': 180000, '5m': 300000, '15m': 900000, '30m': 1800000, '1h': 3600000,
+    '2h': 7200000, '4h': 14400000, '6h': 21600000, '8h': 28800000, '12h': 43200000, '1d': 86400000,
+}
+
+target_allocation = {
+    'BTC': 0.50,
+    'ETH': 0.30,
+}
+
+worker_pool = ThreadPoolExecutor(max_workers=execution_workers)
+
+# Time source for everything that schedules trading work or ages cached data. A replay swaps in a
+# ReplayClock so that recorded sessions run against their recorded timestamps
+class Clock:
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+clock = Clock()
+shutdown = threading.Event()  # Set on SIGINT/SIGTERM; no new cycle, stage or trade starts afterwards
+running = {}  # id(bot) -> (bot, purchase_prices, event set once its mode loop has stopped)
+orders_closed = threading.Event()  # Set at the shutdown deadline; no order is submitted afterwards
+recorder = None  # MarketRecorder capturing exchange responses and stream messages, if enabled
+
 # Telegram bot setup
 telegram_bot_token = 'your_telegram_bot_token'
+telegram_chat_id = 'your_telegram_chat_id'
+binance_api_key = 'your_api_key'  # Used by the console entry point; Telegram users supply their own
+binance_api_secret = 'your_api_secret'
 updater = Updater(token=telegram_bot_token, use_context=True)
 dispatcher = updater.dispatcher
 # Define states for conversation
@@ -42,8 +210,8 @@ def api_secret(update, context):
     global user_api_secret
     user_api_secret = update.message.text
 
-    # Initialize Binance client with user-provided API and Secret
-    context.user_data['client'] = Client(user_api_key, user_api_secret)
+    # The Binance client itself is created on first use by BinanceAPI
+    context.user_data['credentials'] = (user_api_key, user_api_secret)
     update.message.reply_text(
         "API Secret received. Please choose a trading mode:\n"
         "1. AST (Automated Smart Trading)\n"
@@ -56,27 +224,27 @@ def api_secret(update, context):
 
 def mode_selection(update, context):
     choice = update.message.text
-    client = context.user_data.get('client')
+    credentials = context.user_data.get('credentials')
 
-    if client is None:
+    if credentials is None:
         update.message.reply_text("Error initializing Binance client. Please restart the bot and try again.")
         return ConversationHandler.END
 
     notifier = TelegramNotifier(telegram.Bot(token=telegram_bot_token), update.message.chat_id)
-    bot = TradingBot(BinanceAPI(client), notifier)
+    bot = TradingBot(BinanceAPI.from_credentials(*credentials, notifier=notifier), notifier)
 
     if choice == '1':
         update.message.reply_text("Starting AST mode...")
-        start_ast(bot)
+        start_in_background(start_ast, bot)
     elif choice == '2':
         update.message.reply_text("Starting AST+ mode...")
-        start_ast_plus(bot)
+        start_in_background(start_ast_plus, bot)
     elif choice == '3':
         update.message.reply_text("Starting SST mode...")
-        start_sst(bot)
+        start_in_background(start_sst, bot)
     elif choice == '4':
         update.message.reply_text("Starting SST+ mode...")
-        start_sst_plus(bot)
+        start_in_background(start_sst_plus, bot)
     else:
         update.message.reply_text("Invalid choice. Please restart the bot and try again.")
         return ConversationHandler.END
@@ -100,161 +268,1869 @@ conv_handler = ConversationHandler(
 
 dispatcher.add_handler(conv_handler)
 
+# Operator diagnostics run inside the live process, so the state that made a cycle slow is kept.
+# Reports are sent back as a text file; only chats in operator_chat_ids may use them
+diagnostics_lock = threading.Lock()
+
+def sample_profile(seconds, interval=profile_sample_interval):
+    # Sampling profiler over every other thread: counts how often each function is executing (self)
+    # or anywhere on the stack (total). Costs one stack walk per thread per sample
+    own_thread = threading.get_ident()
+    own_counts, total_counts = {}, {}
+    samples = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            seen = set()
+            innermost = True
+            while frame is not None:
+                code = frame.f_code
+                key = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                if innermost:
+                    own_counts[key] = own_counts.get(key, 0) + 1
+                    innermost = False
+                if key not in seen:
+                    seen.add(key)
+                    total_counts[key] = total_counts.get(key, 0) + 1
+                frame = frame.f_back
+        samples += 1
+        time.sleep(interval)
+
+    lines = [f"{samples} samples over {seconds:g}s; percentages are of samples, summed over threads", "",
+             " Total   Self  Function"]
+    for key, total in sorted(total_counts.items(), key=lambda item: -item[1])[:profile_top]:
+        lines.append(f"{100 * total / samples:5.1f}% {100 * own_counts.get(key, 0) / samples:5.1f}%  {key}")
+    return '\n'.join(lines)
+
+def memory_snapshot(seconds):
+    # Allocations still alive from a window of tracing, grouped by line. If tracing is already on,
+    # the snapshot is taken at once and covers everything since it started
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+        time.sleep(seconds)
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    if started:
+        tracemalloc.stop()
+    stats = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics('lineno')
+    lines = [f"Traced memory: {current / 1e6:.1f} MB current, {peak / 1e6:.1f} MB peak", ""]
+    lines.extend(str(stat) for stat in stats[:profile_top])
+    return '\n'.join(lines)
+
+def run_diagnostic(update, context, name, fn):
+    if update.effective_chat.id not in operator_chat_ids:
+        return
+    try:
+        seconds = min(float(context.args[0]) if context.args else 30, profile_max_seconds)
+    except ValueError:
+        update.message.reply_text(f"Usage: /{name} [seconds]")
+        return
+    if not diagnostics_lock.acquire(blocking=False):
+        update.message.reply_text("Another diagnostic is still running.")
+        return
+    update.message.reply_text(f"Running /{name} for {seconds:g}s...")
+
+    def run():
+        try:
+            report = fn(seconds)
+            context.bot.send_document(update.effective_chat.id, document=io.BytesIO(report.encode()),
+                                      filename=f"{name}_{int(time.time())}.txt")
+        except Exception as e:
+            logging.error(f"/{name} failed: {e}")
+            context.bot.send_message(update.effective_chat.id, f"/{name} failed: {e}")
+        finally:
+            diagnostics_lock.release()
+    threading.Thread(target=run, daemon=True).start()
+
+def profile(update, context):
+    run_diagnostic(update, context, 'profile', sample_profile)
+
+def memsnap(update, context):
+    run_diagnostic(update, context, 'memsnap', memory_snapshot)
+
+dispatcher.add_handler(CommandHandler('profile', profile))
+dispatcher.add_handler(CommandHandler('memsnap', memsnap))
+
 # Utility class for managing Telegram notifications
+# Messages are queued and delivered by a background thread so that sending never stalls the trading path
 class TelegramNotifier:
     def __init__(self, bot, chat_id):
         self.bot = bot
         self.chat_id = chat_id
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._deliver, daemon=True)
+        self._worker.start()
+
+    def send_message(self, message, reply_markup=None):
+        self._queue.put((message, reply_markup))
+
+    def flush(self, timeout):
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
 
-    def send_message(self, message):
+    def _deliver(self):
+        while True:
+            message, reply_markup = self._queue.get()
+            try:
+                self.bot.send_message(chat_id=self.chat_id, text=message, reply_markup=reply_markup)
+            except Exception as e:
+                logging.error(f"Failed to send Telegram message: {e}")
+            finally:
+                self._queue.task_done()
+
+# Raised instead of calling an endpoint whose circuit breaker is open
+class CircuitOpenError(Exception):
+    pass
+
+# Raised instead of submitting an order once shutdown has closed order submission
+class OrdersClosedError(Exception):
+    pass
+
+# Tracks consecutive failures of one symbol, stage or endpoint and pauses it with exponential backoff
+class CircuitBreaker:
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0
+
+    def allow(self):
+        return clock.time() >= self.open_until
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures < breaker_threshold:
+            return False
+        delay = min(breaker_max_delay, breaker_base_delay * 2 ** (self.failures - breaker_threshold))
+        self.open_until = clock.time() + delay
+        return True
+
+class CircuitBreakers:
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._breakers.setdefault(key, CircuitBreaker())
+
+# One python-binance client per API key, shared by every BinanceAPI trading with that key. Requests
+# reuse the client's keep-alive connection pool, and for keyed clients the offset to the exchange
+# clock is measured once per key and kept fresh. Keyless clients only call public endpoints
+class ClientPool:
+    def __init__(self):
+        self._clients = {}
+        self._synced = {}  # id(client) -> time the offset was last measured
+        self._lock = threading.Lock()
+
+    def get(self, api_key, api_secret):
+        with self._lock:
+            client = self._clients.get((api_key, api_secret))
+            if client is None:
+                client = self._clients[(api_key, api_secret)] = self._create(api_key, api_secret)
+        if api_key:
+            self.sync(client)
+        return client
+
+    def _create(self, api_key, api_secret):
+        from binance.client import Client
+        from requests.adapters import HTTPAdapter
+        client = Client(api_key, api_secret)
+        client.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=execution_workers))
+        if rest_api_url:
+            client.API_URL = rest_api_url
+        return client
+
+    def sync(self, client, force=False):
+        # The offset is taken against the midpoint of the request, so signed timestamps land on the
+        # exchange clock and are not refused with -1021
+        if not force and time.time() - self._synced.get(id(client), 0) < server_time_refresh:
+            return
+        self._synced[id(client)] = time.time()
         try:
-            self.bot.send_message(chat_id=self.chat_id, text=message)
-        except Exception as e:
-            logging.error(f"Failed to send Telegram message: {e}")
+            before = time.time()
+            server_time = client.get_server_time()['serverTime']
+            client.timestamp_offset = server_time - int((before + time.time()) * 500)
+        except (BinanceAPIException, ConnectionError, Timeout) as e:
+            logging.warning(f"Keeping previous server time offset: {e}")
+
+client_pool = ClientPool()
+
+# A single market order of a conversion route: spend from_coin on symbol to receive to_coin
+TradeLeg = namedtuple('TradeLeg', ['symbol', 'side', 'from_coin', 'to_coin'])
+
+# Outcome of a completed conversion; price is the average fill price of to_coin in stable_coin
+TradeResult = namedtuple('TradeResult', ['path', 'amount', 'price'])
 
 # Utility class for handling Binance API interactions
 class BinanceAPI:
-    def __init__(self, client):
-        self.client = client
-
-    def get_historical_data(self, symbol, interval='1h', limit=100):
-        for i in range(5):
+    def __init__(self, client, notifier=None):
+        self._client = client
+        self._credentials = None
+        self._client_lock = threading.Lock()
+        self.notifier = notifier
+        self._klines = {}
+        self._symbols = {}
+        self._symbols_time = 0
+        self._book_tops = {}
+        self._book_tops_time = 0
+        self._trading_fee = None
+        self._prices = {}
+        self.breakers = CircuitBreakers()
+        self.pending_orders = {}  # clientOrderId -> TradeLeg of submissions whose outcome is not yet known
+        self.open_trades = {}  # trade id -> [from_coin, to_coin, coin held, amount held] while its legs run
+        self.interrupted = {}  # Open trades whose run ended with an order outcome still unknown
+        self._submitting = set()  # Pending client order ids a place_order call is still handling
+        self._pending_lock = threading.Lock()
+        self.execution = ExecutionEngine(self)
+        self.user_stream = None
+        self.market_data = market_candles
+        self.candles = market_candles.aggregator
+        self.market_stream = None
+        self.market_feed = market_feed
+
+    @classmethod
+    def from_credentials(cls, api_key, api_secret, notifier=None):
+        binance_api = cls(None, notifier)
+        binance_api._credentials = (api_key, api_secret)
+        return binance_api
+
+    @property
+    def client(self):
+        # Deferred so that startup does not wait on the connectivity ping Client performs
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = client_pool.get(*self._credentials)
+        return self._client
+
+    def export_state(self):
+        # Only what the order path reads is kept of the exchange info; prices are not kept, as they
+        # are stale by the time the state is loaded
+        keep = ('symbol', 'status', 'baseAsset', 'quoteAsset', 'quotePrecision', 'quoteAssetPrecision')
+        symbols = {}
+        for name, info in self._symbols.items():
+            if info.get('status', 'TRADING') != 'TRADING':
+                continue
+            symbols[name] = {k: info[k] for k in keep if k in info}
+            symbols[name]['filters'] = [f for f in info.get('filters', []) if f['filterType'] in warm_state_filters]
+        return {
+            'symbols': symbols,
+            'symbols_time': self._symbols_time,
+            'klines': {key: klines.rows() for key, klines in self._klines.items()},
+            'trading_fee': self._trading_fee,
+            'pending_orders': {client_order_id: list(leg) for client_order_id, leg in self.pending_orders.items()},
+            'open_trades': {**self.interrupted, **self.open_trades},
+        }
+
+    def load_state(self, state):
+        self._symbols = state.get('symbols', {})
+        self._symbols_time = state.get('symbols_time', 0)
+        self._klines = {key: KlineBuffer.from_rows(rows) for key, rows in state.get('klines', {}).items()}
+        self._trading_fee = state.get('trading_fee')
+        self.pending_orders = {client_order_id: TradeLeg(*leg) for client_order_id, leg in state.get('pending_orders', {}).items()}
+        self.interrupted = state.get('open_trades', {})
+
+    def notify(self, message):
+        if self.notifier is not None:
+            self.notifier.send_message(message)
+
+    def _is_transient(self, error):
+        if isinstance(error, BinanceAPIException):
+            return error.status_code >= 500 or error.code in transient_error_codes
+        return True
+
+    def _should_retry(self, error, policy):
+        if policy.idempotent:
+            return self._is_transient(error)
+        return isinstance(error, BinanceAPIException) and error.code in rejected_order_codes
+
+    def _call(self, endpoint, fn, **kwargs):
+        policy = retry_policies.get(endpoint, retry_policies['default'])
+        breaker = self.breakers.get(endpoint) if policy.idempotent else None
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(f"{endpoint} is paused after repeated failures")
+
+        if self._credentials is not None and self._credentials[0]:
+            client_pool.sync(self.client)
+        deadline = clock.time() + policy.deadline
+        delay = policy.base_delay
+        for attempt in range(1, policy.attempts + 1):
             try:
-                klines = self.client.get_klines(symbol=symbol, interval=interval, limit=limit)
-                df = pd.DataFrame(klines, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume', 'close_time',
-                                                   'quote_av', 'trades', 'tb_base_av', 'tb_quote_av', 'ignore'])
-                df['close'] = df['close'].astype(float)
-                return df
+                result = fn(**kwargs)
+                if recorder is not None:
+                    recorder.record('rest', fn.__name__, result, kwargs)
+                break
             except (BinanceAPIException, ConnectionError, Timeout) as e:
-                logging.error(f"Exception during fetching historical data for {symbol}: {e}")
-                if i < 4:
-                    time.sleep(2 ** i + random.random())
-                else:
-                    notifier.send_message(f"Failed to fetch data for {symbol} after 5 retries.")
-        return pd.DataFrame()
+                if recorder is not None:
+                    recorder.record_error(fn.__name__, e, kwargs)
+                if isinstance(e, BinanceAPIException) and e.code == -1021 and self._credentials is not None and self._credentials[0]:
+                    client_pool.sync(self.client, force=True)
+                # Decorrelated jitter: each delay is drawn between the base and three times the previous one
+                delay = min(policy.max_delay, random.uniform(policy.base_delay, delay * 3))
+                if attempt == policy.attempts or clock.time() + delay > deadline or not self._should_retry(e, policy):
+                    if breaker is not None and self._is_transient(e) and breaker.record_failure():
+                        logging.warning(f"Circuit opened for {endpoint} after {breaker.failures} failures")
+                    raise
+                logging.warning(f"{endpoint} attempt {attempt} failed, retrying in {delay:.2f}s: {e}")
+                clock.sleep(delay)
+
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+    def _fetch_klines(self, symbol, interval, limit):
+        # Only the candles opened since the cached series ended are requested; the last cached
+        # candle is fetched again because it may have been incomplete. The buffer is reused
+        key = f"{symbol}:{interval}"
+        klines = self._klines.get(key)
+        if klines is None or klines.capacity < limit:
+            klines = self._klines[key] = KlineBuffer(max(limit, candle_history))
+        if len(klines) and interval in interval_ms:
+            missing = (int(clock.time() * 1000) - klines.last_open()) // interval_ms[interval] + 1
+            if missing < limit:
+                klines.extend(self._call('klines', self.client.get_klines, symbol=symbol, interval=interval, limit=missing))
+                return klines
+        klines.clear()
+        klines.extend(self._call('klines', self.client.get_klines, symbol=symbol, interval=interval, limit=limit))
+        return klines
+
+    def get_candles(self, symbol, interval='1h', limit=100):
+        # Returns (times, prices) arrays as KlineBuffer.tail does. Served from the in-memory
+        # aggregator while the market stream is live; otherwise fetched over REST, which also
+        # (re)seeds the aggregator for that timeframe
+        candles = self.candles.candles(symbol, interval, limit) if interval in interval_ms else None
+        if candles is not None:
+            return candles
+        candles = self._fetch_klines(symbol, interval, limit).tail(limit)
+        self.candles.seed(symbol, interval, *candles)
+        return candles
 
-    def get_balance(self, asset):
+    def get_historical_data(self, symbol, interval='1h', limit=100):
+        import pandas as pd
         try:
-            balance = self.client.get_asset_balance(asset=asset)
-            return float(balance['free'])
-        except BinanceAPIException as e:
-            logging.error(f"Binance API exception: {e}")
-        return 0
+            times, prices = self.get_candles(symbol, interval, limit)
+        except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError) as e:
+            logging.error(f"Exception during fetching historical data for {symbol}: {e}")
+            self.notify(f"Failed to fetch data for {symbol}: {e}")
+            return pd.DataFrame()
+        columns = {'timestamp': times[:, 0], 'close_time': times[:, 1]}
+        columns.update((name, prices[:, i]) for i, name in enumerate(KlineBuffer.price_columns))
+        return pd.DataFrame(columns)
+
+    def retain(self, symbols):
+        self._klines = {key: klines for key, klines in self._klines.items() if key.split(':')[0] in symbols}
+        self.market_data.retain(self, symbols)
+
+    def start_market_stream(self, symbols):
+        self.market_stream = self.market_data.subscribe(self, symbols)
+        return self.market_stream
+
+    def start_user_stream(self):
+        if websocket is None:
+            logging.warning("websocket-client is not installed; balances will be polled over REST.")
+            return None
+        if self.user_stream is None:
+            self.user_stream = UserDataStream(self)
+            self.user_stream.start()
+        return self.user_stream
+
+    def _stream_state(self):
+        if self.user_stream is not None and self.user_stream.synced.is_set():
+            return self.user_stream.state
+        return None
+
+    # Balance and price errors propagate once retries are exhausted, so callers never act on a made-up zero
+    def get_balance(self, asset):
+        state = self._stream_state()
+        if state is not None:
+            return state.balance(asset)
+        balance = self._call('balance', self.client.get_asset_balance, asset=asset)
+        return float(balance['free'])
 
     def get_price(self, symbol):
         try:
-            ticker = self.client.get_symbol_ticker(symbol=symbol)
-            return float(ticker['price'])
-        except BinanceAPIException as e:
-            logging.error(f"Binance API exception: {e}")
-        return 0
+            ticker = self._call('ticker', self.client.get_symbol_ticker, symbol=symbol)
+        except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError):
+            if symbol not in self._prices:
+                raise
+            logging.warning(f"Using cached price for {symbol}")
+            return self._prices[symbol]
+        self._prices[symbol] = float(ticker['price'])
+        return self._prices[symbol]
+
+    def get_balances(self):
+        state = self._stream_state()
+        if state is not None:
+            return state.balances()
+        try:
+            account = self._call('account', self.client.get_account)
+            return {b['asset']: float(b['free']) for b in account['balances']}
+        except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError) as e:
+            logging.error(f"Failed to retrieve account balances: {e}")
+        return {}
+
+    def get_prices(self):
+        snapshot = self.market_feed.latest() if self.market_feed is not None else None
+        if snapshot is not None:
+            self._prices = snapshot['prices']
+            return dict(self._prices)
+        try:
+            self._prices = {t['symbol']: float(t['price']) for t in self._call('ticker', self.client.get_all_tickers)}
+        except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError) as e:
+            logging.error(f"Failed to retrieve prices, using cached prices: {e}")
+        return dict(self._prices)
 
     def get_trading_fee(self):
+        if self._trading_fee is not None:
+            return self._trading_fee
         try:
-            fees = self.client.get_trade_fee()
-            return float(fees['tradeFee'][0]['taker'])
-        except (BinanceAPIException, ConnectionError, Timeout) as e:
+            fees = self._call('trade_fee', self.client.get_trade_fee)
+            self._trading_fee = float(fees['tradeFee'][0]['taker'])
+            return self._trading_fee
+        except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError) as e:
             logging.error(f"Failed to retrieve trading fee: {e}")
             return 0.001
 
-    def execute_trade(self, from_coin, to_coin):
-        from_to_stable = f"{from_coin}{stable_coin}"
-        stable_to_to = f"{to_coin}{stable_coin}"
-        trading_fee = self.get_trading_fee()
+    def get_symbol_info(self, symbol):
+        return self.get_symbols().get(symbol)
 
-        amount = self.get_balance(from_coin)
-        if amount == 0:
+    def get_symbols(self):
+        if self.market_feed is not None and self.market_feed.symbols:
+            return self.market_feed.symbols
+        if not self._symbols or clock.time() - self._symbols_time > exchange_info_ttl:
+            try:
+                info = self._call('exchange_info', self.client.get_exchange_info)
+                self._symbols = {s['symbol']: s for s in info['symbols'] if s['status'] == 'TRADING'}
+                self._symbols_time = clock.time()
+            except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError) as e:
+                logging.error(f"Failed to retrieve exchange info: {e}")
+        return self._symbols
+
+    def get_24h_tickers(self):
+        return {t['symbol']: t for t in self._call('ticker_24h', self.client.get_ticker)}
+
+    def get_book_tops(self):
+        snapshot = self.market_feed.latest() if self.market_feed is not None else None
+        if snapshot is not None:
+            return snapshot['book_tops']
+        if clock.time() - self._book_tops_time > book_ticker_ttl:
+            try:
+                tickers = self._call('book_ticker', self.client.get_orderbook_tickers)
+                self._book_tops = {t['symbol']: (float(t['bidPrice']), float(t['askPrice'])) for t in tickers}
+                self._book_tops_time = clock.time()
+            except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError) as e:
+                logging.error(f"Failed to retrieve order book tickers: {e}")
+        return self._book_tops
+
+    def get_book_top(self, symbol):
+        return self.get_book_tops().get(symbol)
+
+    def _leg(self, from_coin, to_coin):
+        if self.get_symbol_info(f"{from_coin}{to_coin}"):
+            return TradeLeg(f"{from_coin}{to_coin}", 'SELL', from_coin, to_coin)
+        if self.get_symbol_info(f"{to_coin}{from_coin}"):
+            return TradeLeg(f"{to_coin}{from_coin}", 'BUY', from_coin, to_coin)
+        return None
+
+    def _route_cost(self, route):
+        fee = self.get_trading_fee()
+        cost = 0
+        for leg in route:
+            top = self.get_book_top(leg.symbol)
+            if top is None or top[0] <= 0 or top[1] <= 0:
+                return None
+            bid, ask = top
+            cost += fee + (ask - bid) / (ask + bid)  # Taker fee plus half the relative spread
+        return cost
+
+    def plan_route(self, from_coin, to_coin):
+        candidates = [[self._leg(from_coin, to_coin)]]
+        for hub in (stable_coin, route_coin):
+            if hub not in (from_coin, to_coin):
+                candidates.append([self._leg(from_coin, hub), self._leg(hub, to_coin)])
+
+        best_route, best_cost = None, None
+        for route in candidates:
+            if None in route:
+                continue
+            cost = self._route_cost(route)
+            if cost is not None and (best_cost is None or cost < best_cost):
+                best_route, best_cost = route, cost
+        return best_route
+
+    def _format_amount(self, amount, step):
+        step = Decimal(step).normalize()
+        return format(Decimal(str(amount)).quantize(step, rounding=ROUND_DOWN), 'f')
+
+    def get_filter(self, symbol, filter_type, key):
+        info = self.get_symbol_info(symbol)
+        return next(f[key] for f in info['filters'] if f['filterType'] == filter_type)
+
+    def min_notional(self, symbol):
+        info = self.get_symbol_info(symbol)
+        if info is None:
+            return default_min_notional
+        for f in info['filters']:
+            if f['filterType'] in ('NOTIONAL', 'MIN_NOTIONAL'):
+                return float(f['minNotional'])
+        return default_min_notional
+
+    def quote_step(self, symbol):
+        info = self.get_symbol_info(symbol)
+        return Decimal(1).scaleb(-int(info.get('quoteAssetPrecision', info.get('quotePrecision', 8))))
+
+    def get_depth(self, symbol, limit=depth_limit):
+        book = self._call('depth', self.client.get_order_book, symbol=symbol, limit=limit)
+        return ([(float(p), float(q)) for p, q in book['bids']],
+                [(float(p), float(q)) for p, q in book['asks']])
+
+    def place_order(self, leg, fn, client_order_id, **kwargs):
+        # The client order id stays in pending_orders until the outcome is known. A submission whose
+        # outcome is unknown is looked up by that id; only one that never reached the exchange is sent again
+        # If the lookup fails too, the id stays pending and settle_orders retries it on later cycles
+        with self._pending_lock:
+            if orders_closed.is_set():
+                raise OrdersClosedError(f"Order {client_order_id} not submitted: shutting down")
+            self.pending_orders[client_order_id] = leg
+            self._submitting.add(client_order_id)
+        try:
+            for attempt in range(order_reconcile_attempts):
+                try:
+                    order = self._call('order', fn, symbol=leg.symbol, newClientOrderId=client_order_id,
+                                       requests_params={'timeout': order_timeout}, **kwargs)
+                except (BinanceAPIException, ConnectionError, Timeout) as e:
+                    # An HTTP 5xx also leaves the order's execution status unknown
+                    if (isinstance(e, BinanceAPIException) and e.code not in unknown_outcome_codes
+                            and e.status_code < 500):
+                        self._order_resolved(client_order_id)
+                        raise
+                    logging.warning(f"Outcome of order {client_order_id} unknown, looking it up: {e}")
+                    order = self.reconcile_order(leg.symbol, client_order_id)
+                    if order is None:
+                        continue
+                self._order_resolved(client_order_id)
+                return order
+            self._order_resolved(client_order_id)
+            raise ConnectionError(f"Order {client_order_id} could not be placed after {order_reconcile_attempts} attempts")
+        finally:
+            with self._pending_lock:
+                self._submitting.discard(client_order_id)
+
+    def reconcile_order(self, symbol, client_order_id):
+        # The order as the exchange has it once it reached a final status, or None if it does not exist.
+        # The user stream answers without a request when it has already seen the order finish
+        for attempt in range(order_reconcile_attempts):
+            state = self._stream_state()
+            order = state.orders.get(client_order_id) if state is not None else None
+            if order is None or order['status'] not in final_order_statuses:
+                try:
+                    order = self._call('order_status', self.client.get_order, symbol=symbol,
+                                       origClientOrderId=client_order_id)
+                except BinanceAPIException as e:
+                    if e.code == -2013:  # Order does not exist
+                        return None
+                    raise
+            if order['status'] in final_order_statuses:
+                return order
+            clock.sleep(1)
+        raise ConnectionError(f"Order {client_order_id} still {order['status']} after {order_reconcile_attempts} lookups")
+
+    def _order_resolved(self, client_order_id):
+        with self._pending_lock:
+            self.pending_orders.pop(client_order_id, None)
+
+    def order_state(self):
+        with self._pending_lock:
+            return sorted(self.pending_orders), sorted({**self.interrupted, **self.open_trades})
+
+    def _trade_orders(self, trade_id):
+        with self._pending_lock:
+            return [client_order_id for client_order_id in self.pending_orders if client_order_id.startswith(f"tg{trade_id}-")]
+
+    def settle_orders(self):
+        # Looks up pending orders no submission is handling any more (left by a failed lookup or by a
+        # previous run). Interrupted trades whose orders are all settled are returned as (coin held,
+        # destination, amount held) when they stopped after some but not all of their legs
+        with self._pending_lock:
+            stale = [(client_order_id, leg) for client_order_id, leg in self.pending_orders.items()
+                     if client_order_id not in self._submitting]
+        for client_order_id, leg in stale:
+            try:
+                order = self.reconcile_order(leg.symbol, client_order_id)
+            except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError) as e:
+                logging.error(f"Order {client_order_id} is still unresolved: {e}")
+                continue
+            self._order_resolved(client_order_id)
+            trade = self.interrupted.get(client_order_id[2:].split('-')[0])
+            if trade is not None and order is not None and float(order['executedQty']) > 0:
+                trade[2:] = [leg.to_coin, self._leg_proceeds(leg, order)]
+
+        unfinished = []
+        for trade_id, (from_coin, to_coin, held, amount) in list(self.interrupted.items()):
+            if self._trade_orders(trade_id):
+                continue
+            del self.interrupted[trade_id]
+            if held not in (from_coin, to_coin):
+                unfinished.append((held, to_coin, amount))
+        return unfinished
+
+    def is_pending(self, coin):
+        with self._pending_lock:
+            return any(coin in (leg.from_coin, leg.to_coin) for leg in self.pending_orders.values())
+
+    def _market_order(self, leg, amount, client_order_id):
+        if leg.side == 'SELL':
+            step = self.get_filter(leg.symbol, 'LOT_SIZE', 'stepSize')
+            return self.place_order(leg, self.client.order_market_sell, client_order_id,
+                                    quantity=self._format_amount(amount, step))
+        return self.place_order(leg, self.client.order_market_buy, client_order_id,
+                                quoteOrderQty=self._format_amount(amount, self.quote_step(leg.symbol)))
+
+    def _execute_leg(self, leg, amount, client_order_id):
+        return self.execution.execute_leg(leg, amount, client_order_id)
+
+    def _leg_proceeds(self, leg, order):
+        # cummulativeQuoteQty and executedQty already aggregate every fill of the order
+        if leg.side == 'SELL':
+            received = float(order['cummulativeQuoteQty'])
+        else:
+            received = float(order['executedQty'])
+        fills = order.get('fills')
+        if fills is None:
+            # Orders resolved by lookup carry no fills; assume the taker fee was paid in to_coin
+            return received * (1 - self.get_trading_fee())
+        commission = sum(float(f['commission']) for f in fills if f['commissionAsset'] == leg.to_coin)
+        return received - commission
+
+    def _average_price(self, order):
+        executed = float(order['executedQty'])
+        return float(order['cummulativeQuoteQty']) / executed if executed else 0
+
+    def _stable_price(self, coin, route, order):
+        if coin == stable_coin:
+            return 1.0
+        if route[-1].symbol == f"{coin}{stable_coin}":
+            return self._average_price(order)
+        top = self.get_book_top(f"{coin}{stable_coin}")
+        return (top[0] + top[1]) / 2 if top else 0
+
+    def execute_trade(self, from_coin, to_coin, amount=None):
+        if amount is None:
+            amount = self.get_balance(from_coin)
+        if amount <= 0:
             logging.info(f"No {from_coin} balance to trade.")
-            return False
+            return None
 
-        from_coin_price = self.get_price(from_to_stable)
-        to_coin_price = self.get_price(stable_to_to)
+        if self.is_pending(from_coin):
+            logging.info(f"An earlier {from_coin} order is still unresolved. Skipping.")
+            return None
 
-        try:
-            order = self.client.order_market_sell(symbol=from_to_stable, quantity=amount)
-            usdt_received = float(order['fills'][0]['price']) * amount * (1 - trading_fee)
-            amount_to_buy = usdt_received / to_coin_price
-            order = self.client.order_market_buy(symbol=stable_to_to, quantity=amount_to_buy)
+        route = self.plan_route(from_coin, to_coin)
+        if route is None:
+            logging.info(f"No tradable route from {from_coin} to {to_coin}.")
+            self.notify(f"Trade skipped: no market route {from_coin} → {to_coin}")
+            return None
 
-            logging.info(f"Traded {from_coin} to {to_coin}, New Amount: {amount_to_buy} {to_coin}")
-            notifier.send_message(f"Trade executed: {from_coin} → {to_coin}, Amount: {amount_to_buy}")
-            return True
+        trade_id = uuid.uuid4().hex[:16]
+        self.open_trades[trade_id] = [from_coin, to_coin, from_coin, amount]
+        try:
+            for index, leg in enumerate(route):
+                order = self._execute_leg(leg, amount, f"tg{trade_id}-{index}")
+                if float(order['executedQty']) <= 0:
+                    # Nothing to carry into the next leg, and no price to record as cost basis
+                    logging.info(f"Trade {from_coin} → {to_coin} stopped: nothing filled on {leg.symbol}")
+                    self.notify(f"Trade not executed: {from_coin} → {to_coin}, nothing filled on {leg.symbol}")
+                    return None
+                amount = self._leg_proceeds(leg, order)
+                self.open_trades[trade_id][2:] = [leg.to_coin, amount]
+
+            path = ' → '.join([from_coin] + [leg.to_coin for leg in route])
+            result = TradeResult(path, amount, self._stable_price(to_coin, route, order))
+            logging.info(f"Traded {path}, New Amount: {amount} {to_coin}")
+            self.notify(f"Trade executed: {path}, Amount: {amount}")
+            return result
 
         except BinanceAPIException as e:
             logging.error(f"Binance API exception: {e}")
-            notifier.send_message(f"Trade failed: {from_coin} → {to_coin}. Error: {e}")
+            self.notify(f"Trade failed: {from_coin} → {to_coin}. Error: {e}")
         except BinanceOrderException as e:
             logging.error(f"Binance order exception: {e}")
-            notifier.send_message(f"Order failed: {from_coin} → {to_coin}. Error: {e}")
-        return False
+            self.notify(f"Order failed: {from_coin} → {to_coin}. Error: {e}")
+        except OrdersClosedError as e:
+            logging.warning(f"Trade {from_coin} → {to_coin} stopped at shutdown: {e}")
+        finally:
+            # Kept for settle_orders while an order is unresolved or the proceeds of a finished leg
+            # sit in an intermediate coin, whatever stopped the trade
+            trade = self.open_trades.pop(trade_id, None)
+            if trade is not None and (self._trade_orders(trade_id) or trade[2] not in (from_coin, to_coin)):
+                self.interrupted[trade_id] = trade
+        return None
+
+# Order-book-aware execution: legs that would walk the book are sliced into capped IOC limit orders,
+# and whole trades run on a worker pool so the mode loops never wait for them
+class ExecutionEngine:
+    def __init__(self, binance_api, pool=None):
+        self.binance_api = binance_api
+        self._pool = pool or worker_pool
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            if shutdown.is_set():
+                logging.info(f"Shutting down, execution for {key} not started.")
+                return None
+            if key in self._inflight:
+                logging.info(f"Execution for {key} already in progress. Skipping.")
+                return None
+            future = self._pool.submit(fn, *args)
+            self._inflight[key] = future
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def _done(self, key, future):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if future.exception() is not None:
+            logging.error(f"Execution for {key} failed: {future.exception()}")
+
+    def drain(self, timeout):
+        # Cancels executions still queued and waits for running ones; returns how many did not finish
+        with self._lock:
+            futures = list(self._inflight.values())
+        for future in futures:
+            future.cancel()
+        return len(wait(futures, timeout).not_done)
+
+    def estimate_impact(self, levels, amount, by_quote):
+        # Walk the book for amount (base quantity, or quote value when by_quote) and
+        # return the slippage of the average fill price from the touch in basis points
+        if not levels:
+            return None
+        remaining, base, quote = amount, 0, 0
+        for price, qty in levels:
+            take = min(qty, remaining / price) if by_quote else min(qty, remaining)
+            base += take
+            quote += take * price
+            remaining -= take * price if by_quote else take
+            if remaining <= 0:
+                break
+        if remaining > 0 or base == 0:
+            return float('inf')
+        return abs(quote / base - levels[0][0]) / levels[0][0] * 10000
+
+    def execute_leg(self, leg, amount, client_order_id):
+        if amount <= 0:
+            return {'symbol': leg.symbol, 'executedQty': '0', 'cummulativeQuoteQty': '0', 'fills': []}
+        bids, asks = self.binance_api.get_depth(leg.symbol)
+        levels = bids if leg.side == 'SELL' else asks
+        impact = self.estimate_impact(levels, amount, by_quote=leg.side == 'BUY')
+        if impact is not None and impact <= max_impact_bps:
+            return self.binance_api._market_order(leg, amount, client_order_id)
+
+        # No estimate (empty book) or a book too thin to fill the amount at all gets every slice
+        if impact is None or math.isinf(impact):
+            slices = max_slices
+        else:
+            slices = min(max_slices, max(2, math.ceil(impact / max_impact_bps)))
+        logging.info(f"Slicing {leg.side} {leg.symbol} into up to {slices} child orders (impact {impact} bps)")
+        return self._execute_sliced(leg, amount, slices, client_order_id)
+
+    def _execute_sliced(self, leg, amount, slices, client_order_id):
+        api = self.binance_api
+        step = api.get_filter(leg.symbol, 'LOT_SIZE', 'stepSize')
+        tick = api.get_filter(leg.symbol, 'PRICE_FILTER', 'tickSize')
+        min_notional = api.min_notional(leg.symbol)
+        executed, quote, fills = 0, 0, []
+        remaining = amount
+
+        for i in range(slices):
+            bids, asks = api.get_depth(leg.symbol)
+            levels = bids if leg.side == 'SELL' else asks
+            if not levels:
+                break
+            if leg.side == 'SELL':
+                limit_price = bids[0][0] * (1 - max_cross_bps / 10000)
+                band = sum(q for p, q in bids if p >= limit_price)
+                # Slices are at least the minimum notional (plus a lot step, lost to rounding down), and
+                # a remainder too small to trade on its own is merged into this slice
+                qty = max(remaining / (slices - i), min_notional / limit_price + float(step))
+                if (remaining - qty) * limit_price < min_notional:
+                    qty = remaining
+                qty = min(qty, band)
+            else:
+                limit_price = asks[0][0] * (1 + max_cross_bps / 10000)
+                band = sum(q for p, q in asks if p <= limit_price)
+                spend = max(remaining / (slices - i), min_notional + float(step) * limit_price)
+                if remaining - spend < min_notional:
+                    spend = remaining
+                qty = min(spend / limit_price, band)
+            quantity = api._format_amount(qty, step)
+            if float(quantity) * limit_price < min_notional:
+                logging.info(f"Sliced {leg.side} {leg.symbol} stops: {quantity} is below the minimum notional")
+                break
+            fn = api.client.order_limit_sell if leg.side == 'SELL' else api.client.order_limit_buy
+            order = api.place_order(leg, fn, f"{client_order_id}-{i}", timeInForce='IOC', quantity=quantity,
+                                    price=api._format_amount(limit_price, tick))
+            remaining -= float(order['executedQty'] if leg.side == 'SELL' else order['cummulativeQuoteQty'])
+
+            executed += float(order['executedQty'])
+            quote += float(order['cummulativeQuoteQty'])
+            if fills is not None and 'fills' in order:
+                fills.extend(order['fills'])
+            else:
+                fills = None
+            if remaining <= 0:
+                break
+            if i < slices - 1:
+                clock.sleep(slice_interval)
+
+        if remaining > 0:
+            logging.info(f"Sliced {leg.side} {leg.symbol} left {remaining} unfilled after {slices} slices")
+        return {'symbol': leg.symbol, 'executedQty': str(executed), 'cummulativeQuoteQty': str(quote), 'fills': fills}
+
+# In-memory account and order state maintained from the user data stream
+class AccountState:
+    def __init__(self):
+        self._balances = {}
+        self.orders = {}
+        self._as_of = 0  # updateTime of the last REST snapshot, in ms
+        self._lock = threading.Lock()
+
+    def balance(self, asset):
+        with self._lock:
+            return self._balances.get(asset, 0.0)
+
+    def balances(self):
+        with self._lock:
+            return dict(self._balances)
+
+    def load_snapshot(self, account, open_orders):
+        with self._lock:
+            self._balances = {b['asset']: float(b['free']) for b in account['balances']}
+            self.orders = {o['clientOrderId']: o for o in open_orders}
+            self._as_of = account.get('updateTime', 0)
+
+    def apply(self, event):
+        # Events received after the snapshot may describe changes it already contains: those dated
+        # before it are skipped, so a balanceUpdate delta is never counted twice
+        with self._lock:
+            if event['e'] == 'outboundAccountPosition':
+                if event.get('u', event['E']) < self._as_of:
+                    return
+                for b in event['B']:
+                    self._balances[b['a']] = float(b['f'])
+            elif event['e'] == 'balanceUpdate':
+                if event.get('T', event['E']) <= self._as_of:
+                    return
+                self._balances[event['a']] = self._balances.get(event['a'], 0.0) + float(event['d'])
+            elif event['e'] == 'executionReport':
+                self.orders[event['c']] = {
+                    'symbol': event['s'],
+                    'orderId': event['i'],
+                    'clientOrderId': event['c'],
+                    'side': event['S'],
+                    'status': event['X'],
+                    'executedQty': event['z'],
+                    'cummulativeQuoteQty': event['Z'],
+                }
+
+# Reconnecting WebSocket consumer; subclasses supply the URL and handle messages
+class WebSocketConsumer:
+    name = 'WebSocket stream'
+
+    def __init__(self):
+        self._stopped = threading.Event()
+        self._ws = None
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        self.reconnect()
+
+    def reconnect(self):
+        if self._ws is not None:
+            self._ws.close()
+
+    def _url(self):
+        raise NotImplementedError
+
+    def _on_open(self, ws):
+        pass
+
+    def _on_message(self, ws, message):
+        raise NotImplementedError
+
+    def _on_disconnect(self):
+        pass
+
+    def _opened(self, ws):
+        if recorder is not None:
+            recorder.record('open', self.name)
+        self._on_open(ws)
+
+    def _received(self, ws, message):
+        if recorder is not None:
+            recorder.record('message', self.name, message)
+        self._on_message(ws, message)
+
+    def _run(self):
+        delay = 1
+        while not self._stopped.is_set():
+            try:
+                self._ws = websocket.WebSocketApp(self._url(), on_open=self._opened, on_message=self._received)
+                started = time.time()
+                self._ws.run_forever(ping_interval=60, ping_timeout=10)
+                if time.time() - started > stream_reconnect_max_delay:
+                    delay = 1
+            except Exception as e:
+                logging.error(f"{self.name} error: {e}")
+            self._on_disconnect()
+            if self._stopped.is_set():
+                break
+            logging.info(f"{self.name} disconnected, reconnecting in {delay}s")
+            self._stopped.wait(delay + random.random())
+            delay = min(stream_reconnect_max_delay, delay * 2)
+
+# Consumer for the Binance user data stream: keeps the listen key alive, reconnects with backoff
+# and reloads a REST snapshot after every (re)connect so no event gap goes unnoticed
+class UserDataStream(WebSocketConsumer):
+    name = 'User data stream'
+
+    def __init__(self, binance_api, url=None):
+        super().__init__()
+        self.binance_api = binance_api
+        self.url = url or user_stream_url
+        self.state = AccountState()
+        self.synced = threading.Event()
+        self._listen_key = None
+
+    def start(self):
+        super().start()
+        threading.Thread(target=self._keepalive, daemon=True).start()
+
+    def _url(self):
+        if self._listen_key is None:
+            self._listen_key = self.binance_api._call('listen_key', self.binance_api.client.stream_get_listen_key)
+        return f"{self.url}/{self._listen_key}"
+
+    def _keepalive(self):
+        while not self._stopped.wait(listen_key_keepalive):
+            if self._listen_key is None:
+                continue
+            try:
+                self.binance_api._call('listen_key', self.binance_api.client.stream_keepalive, listenKey=self._listen_key)
+            except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError) as e:
+                logging.error(f"Listen key keep-alive failed, requesting a new key: {e}")
+                self._listen_key = None
+                self.reconnect()
+
+    def _resync(self):
+        api = self.binance_api
+        account = api._call('account', api.client.get_account)
+        open_orders = api._call('open_orders', api.client.get_open_orders)
+        self.state.load_snapshot(account, open_orders)
+        self.synced.set()
+        logging.info("User data stream resynchronised from REST snapshot")
+
+    def _on_open(self, ws):
+        try:
+            self._resync()
+        except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError) as e:
+            logging.error(f"User data resync failed: {e}")
+            ws.close()
+
+    def _on_message(self, ws, message):
+        event = json.loads(message)
+        if event.get('e') == 'listenKeyExpired':
+            self._listen_key = None
+            ws.close()
+            return
+        self.state.apply(event)
+
+    def _on_disconnect(self):
+        self.synced.clear()
+
+# Fixed-capacity candle series in typed arrays: int64 open and close times and float64 OHLCV.
+# Raw kline rows (REST strings or stream values) are decoded straight into the arrays, and the
+# oldest candles are dropped once the buffer is full
+class KlineBuffer:
+    price_columns = ('open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, capacity=candle_history):
+        import numpy as np
+        self.times = np.zeros((capacity, 2), dtype=np.int64)  # open time, close time
+        self.prices = np.zeros((capacity, 5), dtype=np.float64)  # open, high, low, close, volume
+        self.size = 0
+
+    @classmethod
+    def from_rows(cls, rows):
+        klines = cls(max(len(rows), candle_history))
+        klines.extend(rows)
+        return klines
+
+    @property
+    def capacity(self):
+        return len(self.times)
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        self.size = 0
+
+    def last_open(self):
+        return int(self.times[self.size - 1, 0])
+
+    def extend(self, rows):
+        # rows are [open_time, open, high, low, close, volume, close_time, ...]; cached candles
+        # opened at or after the first row are replaced
+        if not rows:
+            return
+        import numpy as np
+        rows = rows[-self.capacity:]
+        start = int(np.searchsorted(self.times[:self.size, 0], int(rows[0][0])))
+        drop = max(0, start + len(rows) - self.capacity)
+        if drop:
+            self.times[:start - drop] = self.times[drop:start]
+            self.prices[:start - drop] = self.prices[drop:start]
+            start -= drop
+        end = start + len(rows)
+        self.times[start:end] = [(row[0], row[6]) for row in rows]
+        self.prices[start:end] = [row[1:6] for row in rows]
+        self.size = end
+
+    def assign(self, times, prices):
+        count = min(len(times), self.capacity)
+        self.times[:count] = times[len(times) - count:]
+        self.prices[:count] = prices[len(prices) - count:]
+        self.size = count
+
+    def row(self, index):
+        open_time, close_time = self.times[index].tolist()
+        return [open_time, *self.prices[index].tolist(), close_time]
+
+    def rows(self):
+        return [self.row(i) for i in range(self.size)]
+
+    def tail(self, limit, copy=False):
+        # (times, prices) of the last limit candles; views into the buffer unless copy is set
+        start = max(0, self.size - limit)
+        times, prices = self.times[start:self.size], self.prices[start:self.size]
+        return (times.copy(), prices.copy()) if copy else (times, prices)
+
+# Candles per symbol and timeframe, kept current from base-interval updates. Higher timeframes are
+# aggregated incrementally into exchange-aligned buckets (open time a multiple of the interval)
+class CandleAggregator:
+    def __init__(self):
+        self._series = {}  # (symbol, interval) -> KlineBuffer
+        self._partial = {}  # (symbol, interval) -> (open time, volume) of the base candle last merged
+        self._updated = {}
+        self._lock = threading.Lock()
+        self.listeners = []  # Objects with on_price(symbol, price) and on_candle(symbol, interval, candle)
+
+    def seed(self, symbol, interval, times, prices):
+        with self._lock:
+            series = self._series.get((symbol, interval))
+            if series is None:
+                series = self._series[(symbol, interval)] = KlineBuffer()
+            series.assign(times, prices)
+            # The last REST candle already holds the current base candle's volume so far. For the base
+            # interval that volume is known; for higher ones the first stream update of that base
+            # candle is taken as already counted
+            if len(series) and interval == base_interval:
+                self._partial[(symbol, interval)] = (series.last_open(), float(series.prices[len(series) - 1, 4]))
+            elif len(series):
+                now = int(clock.time() * 1000)
+                self._partial[(symbol, interval)] = (now - now % interval_ms[base_interval], None)
+            else:
+                self._partial.pop((symbol, interval), None)
+            # Every completed candle is passed on, so listeners start from the whole history; ones
+            # they have seen before are ignored by its open time
+            for index in range(len(series) - 1):
+                row = series.row(index)
+                for listener in self.listeners:
+                    listener.on_candle(symbol, interval, row)
+
+    def update(self, symbol, candle):
+        # candle is a base-interval candle, possibly still open and updated again later
+        with self._lock:
+            self._updated[symbol] = clock.time()
+            for key, series in self._series.items():
+                if key[0] == symbol:
+                    self._merge(key, series, candle)
+            for listener in self.listeners:
+                listener.on_price(symbol, candle[4])
+
+    def _merge(self, key, series, candle):
+        open_time, o, h, l, c, v, _ = candle
+        length = interval_ms[key[1]]
+        bucket = open_time - open_time % length
+        last_open = series.last_open() if len(series) else None
+        if last_open is None or bucket > last_open:
+            series.extend([[bucket, o, h, l, c, v, bucket + length - 1]])
+            if last_open is not None:
+                for listener in self.listeners:
+                    listener.on_candle(key[0], key[1], series.row(len(series) - 2))
+        elif bucket == last_open:
+            previous_open, previous_volume = self._partial.get(key, (None, 0.0))
+            last = series.prices[len(series) - 1]
+            last[1] = max(last[1], h)
+            last[2] = min(last[2], l)
+            last[3] = c
+            # A repeated update of the same base candle replaces its volume instead of adding to it
+            if previous_open != open_time:
+                last[4] += v
+            elif previous_volume is not None:
+                last[4] += v - previous_volume
+        else:
+            return
+        self._partial[key] = (open_time, v)
+
+    def retain(self, symbols):
+        with self._lock:
+            for key in [key for key in self._series if key[0] not in symbols]:
+                del self._series[key]
+                self._partial.pop(key, None)
+            for symbol in set(self._updated) - set(symbols):
+                del self._updated[symbol]
+
+    def candles(self, symbol, interval, limit):
+        # None unless the symbol is seeded for interval and its base updates are still flowing
+        with self._lock:
+            series = self._series.get((symbol, interval))
+            fresh = clock.time() - self._updated.get(symbol, 0) < 2 * interval_ms[base_interval] / 1000
+            if not series or not fresh:
+                return None
+            return series.tail(limit, copy=True)
+
+# Combined kline stream for the traded symbols at base_interval, feeding a CandleAggregator
+class MarketStream(WebSocketConsumer):
+    name = 'Market data stream'
+
+    def __init__(self, aggregator, url=None):
+        super().__init__()
+        self.aggregator = aggregator
+        self.url = url or market_stream_url
+        self.symbols = []
+
+    def set_symbols(self, symbols):
+        symbols = sorted(symbols)
+        if symbols != self.symbols:
+            self.symbols = symbols
+            self.reconnect()
+
+    def _url(self):
+        streams = '/'.join(f"{symbol.lower()}@kline_{base_interval}" for symbol in self.symbols)
+        return f"{self.url}?streams={streams}"
+
+    def _on_message(self, ws, message):
+        data = json.loads(message).get('data', {})
+        if data.get('e') != 'kline':
+            return
+        k = data['k']
+        self.aggregator.update(data['s'], [k['t'], float(k['o']), float(k['h']), float(k['l']), float(k['c']),
+                                           float(k['v']), k['T']])
+
+# One candle aggregator and market stream per process, shared by all of its bots: the stream covers
+# the union of their symbols, so a worker serving many chats streams and seeds each symbol once.
+# Candles are dropped only when no bot trades the symbol any more
+class SharedCandles:
+    def __init__(self):
+        self.aggregator = CandleAggregator()
+        self.stream = None
+        self._symbols = {}  # id of the subscribing BinanceAPI -> its symbols
+        self._lock = threading.Lock()
+
+    def _union(self):
+        return set().union(*self._symbols.values())
+
+    def subscribe(self, owner, symbols):
+        with self._lock:
+            self._symbols[id(owner)] = set(symbols)
+            if self.stream is None:
+                if websocket is None:
+                    return None
+                self.stream = MarketStream(self.aggregator)
+                self.stream.symbols = sorted(self._union())
+                self.stream.start()
+            else:
+                self.stream.set_symbols(self._union())
+            return self.stream
+
+    def retain(self, owner, symbols):
+        with self._lock:
+            self._symbols[id(owner)] = set(symbols)
+            self.aggregator.retain(self._union())
+
+market_candles = SharedCandles()
+
+# Maintains the set of tradable coins and decides which of them need a full indicator evaluation
+class UniverseManager:
+    def __init__(self, binance_api):
+        self.binance_api = binance_api
+        self.coins = list(coins)
+        self._built = 0
+        self._reference = {}  # coin -> (price at last full evaluation, time of that evaluation)
+
+    def refresh(self):
+        if not dynamic_universe:
+            self.coins = list(coins)
+            return self.coins
+        if clock.time() - self._built < universe_ttl:
+            return self.coins
+        try:
+            tickers = self.binance_api.get_24h_tickers()
+        except (BinanceAPIException, ConnectionError, Timeout, CircuitOpenError) as e:
+            logging.error(f"Keeping previous coin universe: {e}")
+            return self.coins
+
+        symbols = self.binance_api.get_symbols()
+        bases = {info.get('baseAsset') for info in symbols.values()}
+        candidates = []
+        for symbol, info in symbols.items():
+            base = info.get('baseAsset', '')
+            if (info.get('quoteAsset') != stable_coin or base in universe_excluded_bases
+                    or self.is_leveraged(info, bases)):
+                continue
+            volume = float(tickers.get(symbol, {}).get('quoteVolume', 0))
+            if volume >= universe_min_quote_volume:
+                candidates.append((volume, base))
+        # The configured coins are always traded; volume fills the remaining places
+        pinned = list(coins)
+        if candidates:
+            candidates.sort(reverse=True)
+            ranked = [base for _, base in candidates if base not in pinned]
+            self.coins = pinned + ranked[:max(universe_max_size - len(pinned), 0)]
+            logging.info(f"Coin universe rebuilt with {len(self.coins)} coins")
+        else:
+            self.coins = pinned + [coin for coin in self.coins if coin not in pinned]
+        self._built = clock.time()
+        return self.coins
+
+    @staticmethod
+    def is_leveraged(info, bases):
+        # Leveraged tokens are an existing asset plus a suffix (BTCUP, ETHBEAR), unlike JUP or SUPER
+        permissions = set(info.get('permissions', []))
+        permissions.update(p for group in info.get('permissionSets', []) for p in group)
+        if 'LEVERAGED' in permissions:
+            return True
+        base = info.get('baseAsset', '')
+        return any(base.endswith(suffix) and base[:-len(suffix)] in bases for suffix in leveraged_token_suffixes)
+
+    def invalidate(self):
+        self._built = 0
+
+    def export_state(self):
+        return {'coins': self.coins, 'built': self._built, 'reference': self._reference}
+
+    def load_state(self, state):
+        self.coins = state.get('coins', self.coins)
+        self._built = state.get('built', 0)
+        self._reference = {coin: tuple(reference) for coin, reference in state.get('reference', {}).items()}
+
+    def retain(self, universe):
+        self._reference = {coin: reference for coin, reference in self._reference.items() if coin in universe}
+
+    def prescreen(self, prices):
+        # Vectorised over the bulk ticker: only coins whose price moved enough since their last full
+        # evaluation, or whose evaluation is stale, are returned and get the expensive indicator pass
+        import numpy as np
+        now = clock.time()
+        current = np.array([prices.get(f"{coin}{stable_coin}", 0.0) for coin in self.coins])
+        reference = np.array([self._reference.get(coin, (0.0, 0))[0] for coin in self.coins])
+        evaluated = np.array([self._reference.get(coin, (0.0, 0))[1] for coin in self.coins])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            moved = np.abs(current / reference - 1) >= prescreen_min_move
+        due = (current > 0) & ((reference <= 0) | moved | (now - evaluated >= prescreen_max_age))
+
+        for i in np.flatnonzero(due):
+            self._reference[self.coins[i]] = (float(current[i]), now)
+        return {self.coins[i] for i in np.flatnonzero(due)}
+
+# Strategy rules written as expressions over indicator names, e.g. "sma_50 > sma_200 and rsi < 30".
+# Each rule is parsed once into a tree of NumPy operations that evaluates a whole indicator matrix
+# (one row per symbol) at once; identical subexpressions shared between rules are evaluated once
+class RuleSet:
+    indicator_pattern = re.compile(r'^(open|high|low|close|volume|macd|macd_signal|macd_diff|rsi|rsi_\d+|sma_\d+|ema_\d+)$')
+    comparisons = {ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Lt: operator.lt, ast.LtE: operator.le,
+                   ast.Eq: operator.eq, ast.NotEq: operator.ne}
+    arithmetic = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+
+    def __init__(self, rules):
+        self.rules = dict(rules)
+        self.indicators = set()
+        self._compiled = {action: self._compile(ast.parse(expr, mode='eval').body) for action, expr in self.rules.items()}
+
+    @classmethod
+    def load(cls, path=strategy_rules_file):
+        try:
+            with open(path) as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return cls(default_strategy_rules)
+
+    def _memo(self, node, fn):
+        key = ('expr', ast.dump(node))
+        def run(values):
+            if key not in values:
+                values[key] = fn(values)
+            return values[key]
+        return run
+
+    def _compile(self, node):
+        import numpy as np
+        if isinstance(node, ast.BoolOp):
+            parts = [self._compile(v) for v in node.values]
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return self._memo(node, lambda values: reduce(combine, (p(values) for p in parts)))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.USub)):
+            inner = self._compile(node.operand)
+            negate = np.logical_not if isinstance(node.op, ast.Not) else np.negative
+            return self._memo(node, lambda values: negate(inner(values)))
+        if isinstance(node, ast.Compare):
+            operands = [self._compile(node.left)] + [self._compile(c) for c in node.comparators]
+            ops = [self.comparisons[type(op)] for op in node.ops]
+            pairs = list(zip(ops, operands, operands[1:]))
+            return self._memo(node, lambda values: reduce(np.logical_and, (op(a(values), b(values)) for op, a, b in pairs)))
+        if isinstance(node, ast.BinOp) and type(node.op) in self.arithmetic:
+            op, left, right = self.arithmetic[type(node.op)], self._compile(node.left), self._compile(node.right)
+            return self._memo(node, lambda values: op(left(values), right(values)))
+        if isinstance(node, ast.Name) and self.indicator_pattern.match(node.id):
+            self.indicators.add(node.id)
+            return lambda values: values[node.id]
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return lambda values: node.value
+        raise ValueError(f"Unsupported strategy rule element: {ast.unparse(node)}")
+
+    def evaluate(self, rows):
+        # rows maps symbol -> indicator row; returns symbol -> first matching action, else 'hold'
+        import numpy as np
+        symbols = list(rows)
+        values = {name: np.array([float(rows[s][name]) for s in symbols]) for name in self.indicators}
+        actions = np.full(len(symbols), 'hold', dtype=object)
+        decided = np.zeros(len(symbols), dtype=bool)
+        for action, predicate in self._compiled.items():
+            matched = np.asarray(predicate(values), dtype=bool) & ~decided
+            actions[matched] = action
+            decided |= matched
+        return dict(zip(symbols, actions))
+
+# Per-coin risk state updated in O(1) on every price tick and closed candle: the high since entry and
+# a Wilder ATR. Fixed, trailing and ATR stop levels are read straight from it by the risk checks
+class RiskBook:
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, symbol):
+        if not symbol.endswith(stable_coin):
+            return None
+        return self._state.setdefault(symbol[:-len(stable_coin)], {
+            'entry': None, 'price': 0.0, 'high': 0.0, 'atr': None, 'prev_close': None, 'candle_time': 0, 'samples': 0,
+        })
+
+    def on_price(self, symbol, price):
+        with self._lock:
+            state = self._entry(symbol)
+            if state is not None and price > 0:
+                state['price'] = price
+                state['high'] = max(state['high'], price)
+
+    def export_state(self):
+        with self._lock:
+            return {coin: dict(state) for coin, state in self._state.items()}
+
+    def load_state(self, state):
+        with self._lock:
+            self._state = {coin: dict(entry) for coin, entry in state.items()}
+
+    def retain(self, coins):
+        with self._lock:
+            self._state = {coin: entry for coin, entry in self._state.items() if coin in coins}
+
+    def on_prices(self, prices):
+        for symbol, price in prices.items():
+            self.on_price(symbol, price)
+
+    def on_candle(self, symbol, interval, candle):
+        if interval != atr_interval:
+            return
+        open_time, _, high, low, close = candle[:5]
+        with self._lock:
+            state = self._entry(symbol)
+            if state is None or open_time <= state['candle_time']:
+                return
+            previous = state['prev_close']
+            true_range = high - low if previous is None else max(high - low, abs(high - previous), abs(low - previous))
+            # The first atr_period true ranges are averaged, later ones smoothed in Wilder's way
+            samples = state.get('samples', 0) + 1
+            period = min(samples, atr_period)
+            state['atr'] = true_range if state['atr'] is None else (state['atr'] * (period - 1) + true_range) / period
+            state['samples'] = samples
+            state['prev_close'] = close
+            state['candle_time'] = open_time
+
+    def levels(self, coin, entry):
+        # Returns (last price, stop level, take-profit level) for a position opened at entry
+        with self._lock:
+            state = self._state.get(coin)
+            if state is None or not entry or not state['price']:
+                return None
+            if state['entry'] != entry:
+                state['entry'] = entry
+                state['high'] = max(entry, state['price'])
+            stops = [entry * (1 - stop_loss_threshold)]
+            if trailing_stop_pct:
+                stops.append(state['high'] * (1 - trailing_stop_pct))
+            if state['atr'] and state.get('samples', 0) >= atr_period:
+                stops.append(state['high'] - atr_stop_multiplier * state['atr'])
+            return state['price'], max(stops), entry * (1 + take_profit_threshold)
 
 # Core Trading Bot
 class TradingBot:
     def __init__(self, binance_api, notifier):
         self.binance_api = binance_api
         self.notifier = notifier
+        self.breakers = CircuitBreakers()
+        self.universe = UniverseManager(binance_api)
+        self.snapshot = {}  # symbol -> latest indicator row
+        self.targets = []  # (score, coin) of the top-k rotation destinations, best first
+        self.rules = RuleSet.load()
+        self.actions = {}  # symbol -> action decided for this cycle
+        self.risk = RiskBook()
+        binance_api.candles.listeners.append(self.risk)
+        self.config_version = config.version
+        self._retained = None  # Universe the positions were last pruned against
+        self.checkpointed = 0
+        self.checkpointed_orders = None
+
+    def guard(self, key, fn, *args):
+        # Runs one symbol or stage of the cycle so that its failure cannot abort the others
+        breaker = self.breakers.get(key)
+        if shutdown.is_set() or not breaker.allow():
+            return None
+        try:
+            result = fn(*args)
+        except Exception as e:
+            logging.error(f"Error in {key}: {e}")
+            if breaker.record_failure():
+                self.notifier.send_message(f"{key} paused for {int(breaker.open_until - clock.time())}s after repeated errors: {e}")
+            return None
+        breaker.record_success()
+        return result
+
+    def resume_trades(self, purchase_prices):
+        # Only the proceeds of the interrupted trade move on, not the whole balance of the coin held
+        for coin, to_coin, amount in self.binance_api.settle_orders():
+            logging.info(f"Finishing the interrupted trade of {amount} {coin} to {to_coin}")
+            self.trade_async(coin, to_coin, purchase_prices, amount)
+
+    def trade_async(self, from_coin, to_coin, purchase_prices=None, amount=None):
+        def run():
+            result = self.binance_api.execute_trade(from_coin, to_coin, amount)
+            if result and result.price > 0 and purchase_prices is not None and to_coin != stable_coin:
+                purchase_prices[to_coin] = result.price
+            return result
+        return self.binance_api.execution.submit(from_coin, run)
 
     def calculate_indicators(self, df):
-        df['sma_50'] = SMAIndicator(df['close'], 50).sma_indicator()
-        df['sma_200'] = SMAIndicator(df['close'], 200).sma_indicator()
-        df['ema_20'] = EMAIndicator(df['close'], 20).ema_indicator()
-        df['rsi'] = RSIIndicator(df['close'], 14).rsi()
-        macd = MACD(df['close'])
-        df['macd'] = macd.macd()
-        df['macd_signal'] = macd.macd_signal()
+        # Only indicators referenced by the rules or the target score are computed; the MACD
+        # lines share one MACD computation
+        from ta.trend import SMAIndicator, EMAIndicator, MACD
+        from ta.momentum import RSIIndicator
+        macd = None
+        for name in sorted(self.rules.indicators | score_indicators):
+            if name in df.columns:
+                continue
+            if name.startswith('macd'):
+                macd = macd or MACD(df['close'])
+                df[name] = {'macd': macd.macd, 'macd_signal': macd.macd_signal, 'macd_diff': macd.macd_diff}[name]()
+            elif name.startswith('rsi'):
+                df[name] = RSIIndicator(df['close'], int(name[4:] or 14)).rsi()
+            elif name.startswith('sma_'):
+                df[name] = SMAIndicator(df['close'], int(name[4:])).sma_indicator()
+            elif name.startswith('ema_'):
+                df[name] = EMAIndicator(df['close'], int(name[4:])).ema_indicator()
         return df
-    def trading_strategy(self, symbol):
+
+    def refresh_indicators(self, symbol):
         df = self.binance_api.get_historical_data(symbol)
         if df.empty:
+            self.snapshot.pop(symbol, None)
             return None
+        self.snapshot[symbol] = self.calculate_indicators(df).iloc[-1]
+        return self.snapshot[symbol]
+
+    def features(self, symbol):
+        # Compact view of a snapshot row for the advisor: only the indicators the rules and the
+        # score read, rounded to advisor_precision significant digits
+        row = self.snapshot[symbol]
+        return {name: float(f"{float(row[name]):.{advisor_precision}g}")
+                for name in sorted(self.rules.indicators | score_indicators)
+                if name in row.index and not math.isnan(row[name])}
+
+    def export_state(self):
+        # Latest indicator rows, universe and risk state, so a restart can skip the warm-up fetches
+        return {
+            'snapshot': {symbol: {name: float(value) for name, value in row.items()} for symbol, row in self.snapshot.items()},
+            'universe': self.universe.export_state(),
+            'risk': self.risk.export_state(),
+        }
+
+    def load_state(self, state):
+        import pandas as pd
+        self.snapshot = {symbol: pd.Series(row) for symbol, row in state.get('snapshot', {}).items()}
+        self.universe.load_state(state.get('universe', {}))
+        self.risk.load_state(state.get('risk', {}))
+
+    def retain(self, universe, purchase_prices):
+        # Drops the indicator state and cached candles of symbols that left the universe, and the cost
+        # basis and risk state of those coins unless a position in them is still held
+        symbols = {f"{coin}{stable_coin}" for coin in universe}
+        for symbol in set(self.snapshot) - symbols:
+            del self.snapshot[symbol]
+        self.universe.retain(universe)
+        self.binance_api.retain(symbols)
+        if universe == self._retained:
+            return
+        self._retained = list(universe)
+        removed = [coin for coin in list(purchase_prices) if coin not in universe]
+        balances = self.binance_api.get_balances() if removed else {}
+        if balances:
+            for coin in removed:
+                if not balances.get(coin):
+                    purchase_prices.pop(coin, None)
+        self.risk.retain(set(universe) | set(purchase_prices))
+
+    def score(self, row):
+        # Trend direction, MACD histogram relative to price and RSI distance from neutral;
+        # components an indicator cannot provide yet (NaN during warm-up) count as zero
+        def component(value):
+            return 0.0 if math.isnan(value) else value
+        trend = component(row['sma_50'] - row['sma_200'])
+        trend = math.copysign(1.0, trend) if trend else 0.0
+        momentum = component((row['macd'] - row['macd_signal']) / row['close'] * 100)
+        reversion = component((50 - row['rsi']) / 50)
+        return trend + momentum + reversion
+
+    def rank_targets(self):
+        scored = ((self.score(row), symbol[:-len(stable_coin)]) for symbol, row in self.snapshot.items())
+        self.targets = heapq.nlargest(target_top_k, scored)
+        return self.targets
+
+    def pick_target(self, from_coin):
+        for score, coin in self.targets:
+            if coin != from_coin and score > min_target_score:
+                return coin
+        return stable_coin
+
+    def decide(self, symbols):
+        # All refreshed symbols are evaluated against every rule in one vectorised call
+        rows = {symbol: self.snapshot[symbol] for symbol in symbols if symbol in self.snapshot}
+        self.actions = self.rules.evaluate(rows) if rows else {}
+        return self.actions
+
+    def decisions(self):
+        # What the cycle decided, in a JSON form a replay can compare against the recording
+        return json.loads(json.dumps({'actions': self.actions, 'targets': self.targets}))
 
-        df = self.calculate_indicators(df)
-
-        latest = df.iloc[-1]
-        if latest['sma_50'] > latest['sma_200'] and latest['rsi'] < 30 and latest['macd'] > latest['macd_signal']:
-            return 'buy'
-        elif latest['rsi'] > 70 and latest['macd'] < latest['macd_signal']:
-            return 'sell'
-        return 'hold'
+    def trading_strategy(self, symbol):
+        if symbol not in self.actions:
+            if self.refresh_indicators(symbol) is None:
+                return None
+            self.actions.update(self.rules.evaluate({symbol: self.snapshot[symbol]}))
+        return self.actions[symbol]
+
+    def plan_rebalance(self, target_allocation, balances, prices):
+        # Returns the minimal ordered list of (from_coin, to_coin, amount) trades: sells sized in
+        # the coin, then buys sized in stable_coin and funded by the stable balance plus sell proceeds
+        import numpy as np
+        universe = list(dict.fromkeys(self.universe.coins + list(target_allocation)))
+        price = np.array([prices.get(f"{coin}{stable_coin}", 0.0) for coin in universe])
+        held = np.array([balances.get(coin, 0.0) for coin in universe])
+        target = np.array([target_allocation.get(coin, np.nan) for coin in universe])
+
+        value = held * price
+        stable_balance = balances.get(stable_coin, 0.0)
+        total = value.sum() + stable_balance
+        if total <= 0:
+            return []
+
+        managed = ~np.isnan(target) & (price > 0)
+        delta = np.where(managed, np.nan_to_num(target) * total - value, 0.0)
+        min_notional = np.array([self.binance_api.min_notional(f"{coin}{stable_coin}") for coin in universe])
+        delta[(np.abs(delta) < rebalance_tolerance * total) | (np.abs(delta) < min_notional)] = 0.0
+
+        sells = np.flatnonzero(delta < 0)
+        buys = np.flatnonzero(delta > 0)
+        proceeds = -delta[sells].sum() * (1 - self.binance_api.get_trading_fee())
+        wanted = delta[buys].sum()
+        scale = min(1.0, (stable_balance + proceeds) / wanted) if wanted > 0 else 0.0
+
+        orders = [(universe[i], stable_coin, min(held[i], -delta[i] / price[i])) for i in sells]
+        orders += [(stable_coin, universe[i], delta[i] * scale) for i in buys if delta[i] * scale >= min_notional[i]]
+        return orders
 
     def rebalance_portfolio(self, target_allocation):
-        total_usd_value = sum(self.binance_api.get_balance(coin) * self.binance_api.get_price(f"{coin}{stable_coin}") for coin in coins)
-
-        for coin, target_pct in target_allocation.items():
-            if coin not in coins:
-                continue
+        orders = self.plan_rebalance(target_allocation, self.binance_api.get_balances(), self.binance_api.get_prices())
+        if not orders:
+            return None
 
-            current_value = self.binance_api.get_balance(coin) * self.binance_api.get_price(f"{coin}{stable_coin}")
-            current_pct = current_value / total_usd_value
+        def run():
+            for from_coin, to_coin, amount in orders:
+                logging.info(f"Rebalancing: {from_coin} → {to_coin}, Amount: {amount} {from_coin}")
+                self.binance_api.execute_trade(from_coin, to_coin, amount)
+        return self.binance_api.execution.submit('rebalance', run)
 
-            if current_pct < target_pct:
-                logging.info(f"Rebalancing: Buying more {coin}, Amount: {amount_to_buy}")
-                self.binance_api.execute_trade(stable_coin, coin)
-            elif current_pct > target_pct:
-                logging.info(f"Rebalancing: Selling some {coin}, Amount: {amount_to_sell}")
-                self.binance_api.execute_trade(coin, stable_coin)
     def stop_loss_check(self, purchase_prices):
-        for coin, purchase_price in purchase_prices.items():
-            if purchase_price == 0:
+        self.risk.on_prices(self.binance_api.get_prices())
+        # Trades finishing on the worker pool add entries meanwhile, so a copy is iterated
+        for coin, purchase_price in list(purchase_prices.items()):
+            levels = self.risk.levels(coin, purchase_price)
+            if levels is None:
                 continue
-            current_price = self.binance_api.get_price(f"{coin}{stable_coin}")
-            if (purchase_price - current_price) / purchase_price >= stop_loss_threshold:
-                logging.info(f"Stop-loss triggered for {coin}")
-                self.binance_api.execute_trade(coin, stable_coin)
+            current_price, stop_level, _ = levels
+            if current_price <= stop_level:
+                logging.info(f"Stop-loss triggered for {coin} at {current_price} (stop {stop_level})")
+                self.trade_async(coin, stable_coin)
 
     def take_profit_check(self, purchase_prices):
-        for coin, purchase_price in purchase_prices.items():
-            if purchase_price == 0:
+        for coin, purchase_price in list(purchase_prices.items()):
+            levels = self.risk.levels(coin, purchase_price)
+            if levels is None:
                 continue
-            current_price = self.binance_api.get_price(f"{coin}{stable_coin}")
-            if (current_price - purchase_price) / purchase_price >= take_profit_threshold:
+            current_price, _, take_profit_level = levels
+            if current_price >= take_profit_level:
                 logging.info(f"Take-profit triggered for {coin}")
-                self.binance_api.execute_trade(coin, stable_coin)
+                self.trade_async(coin, stable_coin)
+
+# Settings file watched between cycles. A changed file (or /reload) is validated as a whole and
+# only then applied, at a point where no bot is inside a cycle, so no cycle runs with half of a new
+# configuration. Symbols that join the universe are warmed by the following cycles
+class ConfigReloader:
+    def __init__(self, path=config_file):
+        self.path = path
+        self.version = 0
+        self._mtime = None
+        self._pending = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._active = 0  # Bots currently inside a cycle
+
+    def load(self):
+        with open(self.path) as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("expected an object of settings")
+        return {name: self._validate(name, value) for name, value in config.items()}
+
+    def _validate(self, name, value):
+        kind = reloadable_settings.get(name)
+        if kind is None:
+            raise ValueError(f"{name} cannot be changed without a restart")
+        try:
+            if kind == 'coins':
+                result = [str(coin).upper() for coin in value if str(coin).strip()]
+                valid = isinstance(value, list) and len(result) == len(value) > 0
+            elif kind == 'coin':
+                result = str(value).upper()
+                valid = isinstance(value, str) and result.isalnum()
+            elif kind == 'count':
+                result = int(value)
+                valid = result == value and result > 0
+            elif kind == 'allocation':
+                result = {str(coin).upper(): float(share) for coin, share in value.items()}
+                valid = all(share >= 0 for share in result.values()) and sum(result.values()) <= 1
+            elif kind == 'fraction_or_none' and value is None:
+                result, valid = None, True
+            else:
+                result = float(value)
+                valid = result > 0 and (kind == 'positive' or result < 1)
+        except (TypeError, ValueError, AttributeError):
+            valid = False
+        if not valid:
+            raise ValueError(f"invalid value for {name}: {value!r}")
+        return result
+
+    def request(self):
+        # Validates the file now so /reload can report errors; the settings apply at the next poll
+        settings = self.load()
+        with self._lock:
+            self._pending = settings
+        return settings
+
+    def _check(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if self._pending is None and mtime is not None and mtime != self._mtime:
+            try:
+                self._pending = self.load()
+            except (OSError, ValueError) as e:
+                logging.error(f"Ignoring {self.path}: {e}")
+        self._mtime = mtime
+
+    def _apply(self):
+        settings, self._pending = self._pending, None
+        globals().update(settings)
+        for name in ('klines', 'exchange_info'):
+            retry_policies[name] = retry_policies[name]._replace(attempts=max_retries)
+        self.version += 1
+        logging.info(f"Configuration {self.version} applied: {', '.join(sorted(settings))}")
+
+    def begin_cycle(self):
+        # Called by each bot before its cycle. Pending settings hold new cycles back until the running
+        # ones have ended, are applied, and the version (increased on every change) is returned
+        with self._idle:
+            self._check()
+            while self._pending is not None and self._active:
+                self._idle.wait()
+            if self._pending is not None:
+                self._apply()
+            self._active += 1
+            return self.version
+
+    def end_cycle(self):
+        with self._idle:
+            self._active -= 1
+            self._idle.notify_all()
+
+config = ConfigReloader()
+
+def reload_config(update, context):
+    if update.effective_chat.id not in operator_chat_ids:
+        return
+    try:
+        settings = config.request()
+    except (OSError, ValueError) as e:
+        update.message.reply_text(f"Configuration not reloaded: {e}")
+        return
+    update.message.reply_text(f"Reloading {', '.join(sorted(settings)) or 'nothing'} at the start of the next cycle.")
+
+dispatcher.add_handler(CommandHandler('reload', reload_config))
+
+# Pending SST/SST+ trades awaiting approval through Telegram inline buttons
+PendingTrade = namedtuple('PendingTrade', ['bot', 'action', 'from_coin', 'to_coin', 'price', 'expires', 'purchase_prices'])
+
+class ConfirmationManager:
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def is_pending(self, chat_id, symbol):
+        # Each chat has its own prompts; another user's open prompt for the same symbol does not count
+        with self._lock:
+            return any(p.bot.notifier.chat_id == chat_id and f"{p.from_coin}{stable_coin}" == symbol
+                       for p in self._pending.values())
+
+    def request(self, bot, action, from_coin, to_coin, purchase_prices):
+        symbol = f"{from_coin}{stable_coin}"
+        if self.is_pending(bot.notifier.chat_id, symbol):
+            logging.info(f"Confirmation for {symbol} still pending.")
+            return
+        price = bot.binance_api.get_price(symbol)
+        prompt_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            self._pending[prompt_id] = PendingTrade(bot, action, from_coin, to_coin, price,
+                                                    clock.time() + confirmation_timeout, purchase_prices)
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Confirm", callback_data=f"confirm:{prompt_id}"),
+            InlineKeyboardButton("❌ Decline", callback_data=f"decline:{prompt_id}"),
+        ]])
+        logging.info(f"Suggested action: {action} for {symbol}. Waiting for user confirmation.")
+        bot.notifier.send_message(f"Suggested action: {action} {from_coin} -> {to_coin} at {price}. "
+                                  f"Confirm within {confirmation_timeout // 60} minutes.", reply_markup=keyboard)
+
+    def expire(self):
+        now = clock.time()
+        with self._lock:
+            expired = {k: p for k, p in self._pending.items() if p.expires <= now}
+            for k in expired:
+                del self._pending[k]
+        for p in expired.values():
+            logging.info(f"Confirmation for {p.from_coin} -> {p.to_coin} expired.")
+            p.bot.notifier.send_message(f"Confirmation for {p.action} {p.from_coin} -> {p.to_coin} expired.")
+
+    def handle(self, update, context):
+        query = update.callback_query
+        answer, prompt_id = query.data.split(':', 1)
+        with self._lock:
+            pending = self._pending.pop(prompt_id, None)
+        query.answer()
+
+        if pending is None or pending.expires <= clock.time():
+            query.edit_message_text("This confirmation is no longer valid.")
+            return
+        symbol = f"{pending.from_coin}{stable_coin}"
+        if answer != 'confirm':
+            logging.info(f"User declined the trade for {symbol}.")
+            query.edit_message_text(f"Declined: {pending.action} {pending.from_coin} -> {pending.to_coin}.")
+            return
+
+        price = pending.bot.binance_api.get_price(symbol)
+        if abs(price - pending.price) / pending.price > confirmation_price_tolerance:
+            logging.info(f"Confirmation for {symbol} rejected: price moved from {pending.price} to {price}.")
+            query.edit_message_text(f"Not executed: {symbol} moved from {pending.price} to {price} since the prompt.")
+            return
+
+        query.edit_message_text(f"Confirmed: {pending.action} {pending.from_coin} -> {pending.to_coin} at {price}.")
+        pending.bot.trade_async(pending.from_coin, pending.to_coin, pending.purchase_prices)
+
+confirmations = ConfirmationManager()
+dispatcher.add_handler(CallbackQueryHandler(confirmations.handle, pattern=r'^(confirm|decline):'))
 
 # Handling graceful shutdown
 def signal_handler(sig, frame):
+    if shutdown.is_set():
+        return
     print("Gracefully shutting down the bot...")
-    sys.exit(0)
+    shutdown.set()
+    threading.Thread(target=graceful_shutdown).start()
+
+def graceful_shutdown(deadline=shutdown_deadline):
+    # Mode loops stop at their next stage, trades already started get until the deadline to finish
+    # their legs, then every bot is checkpointed and queued notifications and logs are flushed.
+    # At the deadline order submission is closed before checkpointing, so every order a trade still
+    # running has sent is in the checkpoint; those trades are finished on restart
+    ends = time.time() + deadline
+    children = multiprocessing.active_children()
+    for process in children:
+        process.terminate()  # Supervisor workers run this same shutdown on SIGTERM
+    bots = list(running.values())
+    for bot, _, stopped in bots:
+        stopped.wait(max(0, ends - time.time()))
+    for bot, _, _ in bots:
+        unfinished = bot.binance_api.execution.drain(max(0, ends - time.time()))
+        if unfinished:
+            logging.warning(f"{unfinished} trade(s) still running at shutdown; they resume on restart")
+    orders_closed.set()
+    for bot, purchase_prices, _ in bots:
+        try:
+            save_warm_state(bot, purchase_prices)
+        except (OSError, TypeError, ValueError) as e:
+            logging.error(f"Failed to checkpoint state: {e}")
+        bot.notifier.send_message("Bot stopped. State saved; trading resumes where it left off on restart.")
+    for bot, _, _ in bots:
+        bot.notifier.flush(max(5, ends - time.time()))
+    if recorder is not None:
+        recorder.flush()
+    for process in children:
+        process.join(max(0, ends - time.time()))
+    logging.info("Shutdown complete")
+    logging.shutdown()
+    os._exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
@@ -268,9 +2144,10 @@ def main():
     print("4. SST+ (Semi Smart Trading with ChatGPT)")
 
     choice = input("Enter your choice: ")
+    updater.start_polling()  # Delivers inline-button confirmations for SST/SST+
 
-    binance_api = BinanceAPI(client)
-    notifier = TelegramNotifier(telegram_bot, telegram_chat_id)
+    notifier = TelegramNotifier(updater.bot, telegram_chat_id)
+    binance_api = BinanceAPI.from_credentials(binance_api_key, binance_api_secret, notifier=notifier)
     bot = TradingBot(binance_api, notifier)
 
     if choice == '1':
@@ -293,234 +2170,868 @@ def main():
         print("Invalid choice. Exiting...")
         sys.exit(1)
 
-def start_ast(bot):
-    purchase_prices = {coin: bot.binance_api.get_price(f"{coin}{stable_coin}") for coin in coins}
-    target_allocation = {
-        'BTC': 0.50,
-        'ETH': 0.30,
-    }
-
-    while True:
-        try:
-            for i in range(len(coins)):
-                from_coin = coins[i]
-                to_coin = coins[(i + 1) % len(coins)]
-
-                if bot.binance_api.get_balance(from_coin) == 0:
-                    logging.info(f"No balance in {from_coin}. Skipping trading.")
-                    continue
-
-                symbol = f"{from_coin}{stable_coin}"
-                action = bot.trading_strategy(symbol)
+def warm_state_path(bot):
+    return warm_state_file.format(chat_id=bot.notifier.chat_id)
 
-                if action == 'buy':
-                    if bot.binance_api.execute_trade(from_coin, to_coin):
-                        purchase_prices[to_coin] = bot.binance_api.get_price(f"{to_coin}{stable_coin}")
-                elif action == 'sell':
-                    logging.info(f"Holding {from_coin}. Strategy indicates 'sell'.")
-                else:
-                    logging.info(f"Holding {from_coin}. No trade signals.")
+def load_warm_state(bot):
+    try:
+        with open(warm_state_path(bot)) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.error(f"Ignoring unreadable warm state: {e}")
+        return {}
+    bot.binance_api.load_state(state.get('api', {}))
+    bot.load_state(state.get('bot', {}))
+    logging.info(f"Warm state loaded from {warm_state_path(bot)}")
+    return state
+
+def restore_positions(bot, state):
+    purchase_prices = state.get('purchase_prices')
+    if purchase_prices is None:
+        prices = bot.binance_api.get_prices()
+        purchase_prices = {coin: prices[f"{coin}{stable_coin}"] for coin in coins
+                           if prices.get(f"{coin}{stable_coin}", 0) > 0}
+    return purchase_prices
+
+def save_warm_state(bot, purchase_prices):
+    path = warm_state_path(bot)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump({'api': bot.binance_api.export_state(), 'bot': bot.export_state(), 'purchase_prices': dict(purchase_prices)}, f)
+    os.replace(f"{path}.tmp", path)
+
+def checkpoint(bot, purchase_prices):
+    # The caches only need an occasional snapshot; a change in unresolved orders or open trades is
+    # written at the end of the cycle it happened in
+    orders = bot.binance_api.order_state()
+    if clock.time() - bot.checkpointed < warm_state_interval and orders == bot.checkpointed_orders:
+        return
+    save_warm_state(bot, purchase_prices)
+    bot.checkpointed, bot.checkpointed_orders = clock.time(), orders
+
+def run_mode(bot, evaluate, advise=None):
+    bot.binance_api.start_user_stream()
+    state = load_warm_state(bot)
+    if recorder is not None:
+        recorder.record('state', 'warm', state)
+    purchase_prices = restore_positions(bot, state)
+    bot.resume_trades(purchase_prices)
+
+    stopped = threading.Event()
+    running[id(bot)] = (bot, purchase_prices, stopped)
+    try:
+        while not shutdown.is_set():
+            version = config.begin_cycle()
+            try:
+                if version != bot.config_version:
+                    bot.config_version = version
+                    bot.universe.invalidate()
+                run_cycle(bot, evaluate, advise, purchase_prices)
+                bot.guard('checkpoint', checkpoint, bot, purchase_prices)
+            finally:
+                config.end_cycle()
+            shutdown.wait(cycle_interval)
+    finally:
+        stopped.set()
+
+def run_cycle(bot, evaluate, advise, purchase_prices):
+    if recorder is not None:
+        recorder.record('cycle', 'start')
+    universe = bot.universe.refresh()
+    bot.retain(universe, purchase_prices)
+    bot.binance_api.start_market_stream(f"{coin}{stable_coin}" for coin in universe)
+    due = bot.universe.prescreen(bot.binance_api.get_prices())
+    refreshed = [coin for coin in universe
+                 if coin in due and bot.guard(f"{coin}{stable_coin}", bot.refresh_indicators, f"{coin}{stable_coin}") is not None]
+    bot.rank_targets()
+    bot.decide([f"{coin}{stable_coin}" for coin in refreshed])
+
+    signals = []
+    for from_coin in refreshed:
+        to_coin = bot.pick_target(from_coin)
+        trade = bot.guard(f"{from_coin}{stable_coin}", evaluate, bot, from_coin, to_coin, purchase_prices)
+        if trade is not None:
+            signals.append(trade)
+    if advise is not None and signals:
+        bot.guard('advisor', advise, bot, signals, purchase_prices)
+
+    confirmations.expire()
+    bot.guard('rebalance', bot.rebalance_portfolio, target_allocation)
+    bot.guard('stop_loss', bot.stop_loss_check, purchase_prices)
+    bot.guard('take_profit', bot.take_profit_check, purchase_prices)
+    bot.guard('settle_orders', bot.resume_trades, purchase_prices)
+
+    if recorder is not None:
+        recorder.record('decision', 'cycle', bot.decisions())
+
+def evaluate_ast(bot, from_coin, to_coin, purchase_prices):
+    if bot.binance_api.get_balance(from_coin) == 0:
+        logging.info(f"No balance in {from_coin}. Skipping trading.")
+        return
+
+    symbol = f"{from_coin}{stable_coin}"
+    action = bot.trading_strategy(symbol)
+
+    if action == 'buy':
+        bot.trade_async(from_coin, to_coin, purchase_prices)
+    elif action == 'sell':
+        logging.info(f"Holding {from_coin}. Strategy indicates 'sell'.")
+    else:
+        logging.info(f"Holding {from_coin}. No trade signals.")
+
+def signal_for_advice(bot, from_coin, to_coin, purchase_prices):
+    # Per-coin step of the ChatGPT modes: buy and sell signals are collected and sent to the
+    # advisor together once the cycle has evaluated every coin
+    if bot.binance_api.get_balance(from_coin) == 0:
+        logging.info(f"No balance in {from_coin}. Skipping trading.")
+        return None
+
+    symbol = f"{from_coin}{stable_coin}"
+    action = bot.trading_strategy(symbol)
+
+    if action == 'buy' or action == 'sell':
+        return {
+            "symbol": symbol,
+            "from_coin": from_coin,
+            "to_coin": to_coin,
+            "action": action,
+            "balance": bot.binance_api.get_balance(from_coin),
+            "price": bot.binance_api.get_price(symbol),
+            "indicators": bot.features(symbol)
+        }
+    logging.info(f"Holding {from_coin}. No trade signals.")
+    return None
+
+def advised(bot, signals):
+    # Yields the signals ChatGPT approved and reports every verdict in one message
+    advice = ask_chatgpt_for_advice(signals)
+    report = []
+    for trade in signals:
+        verdict, reason = advice.get(trade['symbol'], ('hold off', 'no verdict returned'))
+        logging.info(f"ChatGPT advice for {trade['symbol']} {trade['action']}: {verdict} ({reason})")
+        report.append(f"{trade['from_coin']} -> {trade['to_coin']} ({trade['action']}): {verdict} - {reason}")
+    bot.notifier.send_message("ChatGPT advice:\n" + "\n".join(report))
+    return [trade for trade in signals if advice.get(trade['symbol'], ('hold off',))[0] == 'proceed']
+
+def evaluate_ast_plus(bot, signals, purchase_prices):
+    for trade in advised(bot, signals):
+        bot.trade_async(trade['from_coin'], trade['to_coin'], purchase_prices)
+
+def evaluate_sst(bot, from_coin, to_coin, purchase_prices):
+    if bot.binance_api.get_balance(from_coin) == 0:
+        logging.info(f"No balance in {from_coin}. Skipping trading.")
+        return
+
+    symbol = f"{from_coin}{stable_coin}"
+    action = bot.trading_strategy(symbol)
+
+    if action == 'buy' or action == 'sell':
+        confirmations.request(bot, action, from_coin, to_coin, purchase_prices)
+    else:
+        logging.info(f"Holding {from_coin}. No trade signals.")
 
-            bot.rebalance_portfolio(target_allocation)
-            bot.stop_loss_check(purchase_prices)
-            bot.take_profit_check(purchase_prices)
+def evaluate_sst_plus(bot, signals, purchase_prices):
+    for trade in advised(bot, signals):
+        confirmations.request(bot, trade['action'], trade['from_coin'], trade['to_coin'], purchase_prices)
 
-            time.sleep(60)
+def start_in_background(start_mode, bot):
+    # Mode loops run forever, so they must not occupy the Telegram dispatcher thread
+    threading.Thread(target=start_mode, args=(bot,), daemon=True).start()
 
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-            bot.notifier.send_message(f"Trading bot encountered an unexpected error: {e}")
-            time.sleep(300)
+def start_ast(bot):
+    run_mode(bot, evaluate_ast)
 
 def start_ast_plus(bot):
-    purchase_prices = {coin: bot.binance_api.get_price(f"{coin}{stable_coin}") for coin in coins}
-    target_allocation = {
-        'BTC': 0.50,
-        'ETH': 0.30,
-    }
+    run_mode(bot, signal_for_advice, evaluate_ast_plus)
 
-    while True:
-        try:
-            for i in range(len(coins)):
-                from_coin = coins[i]
-                to_coin = coins[(i + 1) % len(coins)]
-                if bot.binance_api.get_balance(from_coin) == 0:
-                    logging.info(f"No balance in {from_coin}. Skipping trading.")
-                    continue
-
-                symbol = f"{from_coin}{stable_coin}"
-                action = bot.trading_strategy(symbol)
-
-                if action == 'buy' or action == 'sell':
-                    data = {
-                        "symbol": symbol,
-                        "from_coin": from_coin,
-                        "to_coin": to_coin,
-                        "action": action,
-                        "balance": bot.binance_api.get_balance(from_coin),
-                        "price": bot.binance_api.get_price(symbol),
-                        "indicators": bot.calculate_indicators(bot.binance_api.get_historical_data(symbol)).iloc[-1].to_dict()
-                    }
-
-                    gpt_advice = ask_chatgpt_for_advice(data)
-
-                    logging.info(f"ChatGPT advice: {gpt_advice}")
-                    bot.notifier.send_message(f"ChatGPT advice for {from_coin} -> {to_coin}: {gpt_advice}")
-
-                    if gpt_advice.lower() == 'proceed':
-                        if bot.binance_api.execute_trade(from_coin, to_coin):
-                            purchase_prices[to_coin] = bot.binance_api.get_price(f"{to_coin}{stable_coin}")
-                    else:
-                        logging.info(f"ChatGPT advised not to proceed with {action} action for {symbol}.")
-                        bot.notifier.send_message(f"ChatGPT advised not to proceed with {action} action for {symbol}.")
-                else:
-                    logging.info(f"Holding {from_coin}. No trade signals.")
-
-            bot.rebalance_portfolio(target_allocation)
-            bot.stop_loss_check(purchase_prices)
-            bot.take_profit_check(purchase_prices)
-
-            time.sleep(60)
+def start_sst(bot):
+    run_mode(bot, evaluate_sst)
 
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-            bot.notifier.send_message(f"Trading bot encountered an unexpected error: {e}")
-            time.sleep(300)
+def start_sst_plus(bot):
+    run_mode(bot, signal_for_advice, evaluate_sst_plus)
 
-def ask_chatgpt_for_advice(data):
+def ask_chatgpt_for_advice(signals):
+    # One request per cycle for all signals. Returns {symbol: (verdict, reason)}; symbols the reply
+    # does not cover, or every symbol if the request fails, are left out and treated as 'hold off'
     try:
+        import openai
+        payload = [{key: trade[key] for key in ('symbol', 'action', 'to_coin', 'balance', 'price', 'indicators')}
+                   for trade in signals]
         prompt = (
-            f"You're an advanced trading assistant. Here is the current trading data:\n\n"
-            f"Symbol: {data['symbol']}\n"
-            f"From Coin: {data['from_coin']}\n"
-            f"To Coin: {data['to_coin']}\n"
-            f"Suggested Action: {data['action']}\n"
-            f"Current Balance: {data['balance']}\n"
-            f"Price: {data['price']}\n"
-            f"Technical Indicators: {data['indicators']}\n\n"
-            "Based on this information, should the bot proceed with the trade ('proceed') or hold off ('hold off')?"
+            "You're an advanced trading assistant. Each entry below is a trade the bot's strategy "
+            "suggests, with the current balance, price and technical indicators:\n\n"
+            f"{json.dumps(payload, separators=(',', ':'))}\n\n"
+            "For every symbol decide whether the bot should proceed with the trade or hold off. Reply "
+            'with JSON only, in the form {"SYMBOL": {"verdict": "proceed" or "hold off", "reason": "..."}}.'
         )
 
         response = openai.ChatCompletion.create(
             model="gpt-4",
+            temperature=0,
             messages=[
                 {"role": "system", "content": "You are a helpful assistant for trading decisions."},
                 {"role": "user", "content": prompt}
             ]
         )
 
-        gpt_advice = response['choices'][0]['message']['content'].strip().lower()
-        return gpt_advice
+        content = response['choices'][0]['message']['content']
+        match = re.search(r'\{.*\}', content, re.DOTALL)
+        verdicts = json.loads(match.group(0)) if match else {}
+        return {symbol: (str(verdict.get('verdict', 'hold off')).strip().lower(), verdict.get('reason', ''))
+                for symbol, verdict in verdicts.items() if isinstance(verdict, dict)}
 
     except Exception as e:
         logging.error(f"Error communicating with ChatGPT: {e}")
-        return 'hold off'
-
-def start_sst(bot):
-    purchase_prices = {coin: bot.binance_api.get_price(f"{coin}{stable_coin}") for coin in coins}
-    target_allocation = {
-        'BTC': 0.50,
-        'ETH': 0.30,
-    }
+        return {}
+
+# Market-data recording and replay: with --record-market every exchange response, stream message
+# and cycle decision is appended to a JSON-lines file; --replay-market feeds a recording back
+# through BinanceAPI, at the recorded pace or as fast as possible, and checks the decisions match
+class MarketRecorder:
+    def __init__(self, path):
+        self._file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def record(self, kind, name, payload=None, args=None):
+        entry = {'t': clock.time(), 'k': kind, 'n': name}
+        if args:
+            entry['a'] = args
+        if payload is not None:
+            entry['p'] = payload
+        line = json.dumps(entry, separators=(',', ':'), default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def record_error(self, name, error, args=None):
+        if isinstance(error, BinanceAPIException):
+            payload = {'code': error.code, 'status': error.status_code, 'message': error.message}
+        else:
+            payload = {'message': str(error)}
+        self.record('error', name, payload, args)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+# Virtual time for a replay: advances to each record's timestamp, sleeping the gap scaled by speed,
+# or not at all when speed is None
+class ReplayClock(Clock):
+    def __init__(self, start, speed=None):
+        self.now = start
+        self.speed = speed
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if self.speed:
+            time.sleep(seconds / self.speed)
+        self.now += seconds
+
+    def advance(self, timestamp):
+        if timestamp > self.now:
+            self.sleep(timestamp - self.now)
+
+# Stands in for binance.client.Client during a replay: each method returns the responses recorded
+# for it and its symbol in order, and keeps returning the last one once they run out
+class ReplayClient:
+    def __init__(self, records):
+        self._responses = {}
+        self._last = {}
+        self._lock = threading.Lock()
+        for record in records:
+            if record['k'] in ('rest', 'error'):
+                key = (record['n'], record.get('a', {}).get('symbol'))
+                self._responses.setdefault(key, deque()).append(record)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(**kwargs):
+            key = (name, kwargs.get('symbol'))
+            with self._lock:
+                if self._responses.get(key):
+                    self._last[key] = self._responses[key].popleft()
+                record = self._last.get(key)
+            if record is None:
+                raise ConnectionError(f"No recorded response for {name}")
+            if record['k'] == 'error':
+                error = record['p']
+                if 'code' in error:
+                    raise BinanceAPIException(None, error['status'], json.dumps({'code': error['code'], 'msg': error['message']}))
+                raise ConnectionError(error['message'])
+            return record['p']
+        call.__name__ = name
+        return call
+
+class ReplaySocket:
+    def close(self):
+        pass
+
+class LogNotifier:
+    chat_id = 'replay'
+
+    def send_message(self, message, reply_markup=None):
+        logging.info(f"Notification: {message}")
+
+    def flush(self, timeout):
+        pass
+
+def replay_market(path, speed=None, evaluate=evaluate_ast):
+    global clock
+    records = MarketRecorder.load(path)
+    if not records:
+        print(f"No records in {path}")
+        return
+    clock = ReplayClock(records[0]['t'], speed)
+    api = BinanceAPI(ReplayClient(records))
+    api.user_stream = UserDataStream(api)
+    api.market_data = SharedCandles()  # Fed only by the recording, never by a live stream
+    api.candles = api.market_data.aggregator
+    api.market_stream = api.market_data.stream = MarketStream(api.candles)
+    consumers = {consumer.name: consumer for consumer in (api.user_stream, api.market_stream)}
+    bot = TradingBot(api, LogNotifier())
+    purchase_prices = None
+    cycles = mismatches = 0
+
+    for record in records:
+        clock.advance(record['t'])
+        kind = record['k']
+        if kind == 'state':
+            api.load_state(record['p'].get('api', {}))
+            bot.load_state(record['p'].get('bot', {}))
+            purchase_prices = restore_positions(bot, record['p'])
+        elif kind == 'open':
+            consumers[record['n']]._on_open(ReplaySocket())
+        elif kind == 'message':
+            consumers[record['n']]._on_message(ReplaySocket(), record['p'])
+        elif kind == 'cycle':
+            if purchase_prices is None:
+                purchase_prices = restore_positions(bot, {})
+            run_cycle(bot, evaluate, None, purchase_prices)
+        elif kind == 'decision':
+            cycles += 1
+            if bot.decisions() != record['p']:
+                mismatches += 1
+                logging.warning(f"Replayed cycle {cycles} decided {bot.decisions()}, recording has {record['p']}")
+    print(f"Replayed {len(records)} records and {cycles} cycles: {mismatches} decision mismatches")
+
+# Paper trading: portfolios trade virtual balances with fills simulated against the live order
+# book. All portfolios read public market data through one SharedMarketData, so running many
+# strategy variants costs little more exchange traffic than running one
+class SharedMarketData:
+    def __init__(self, client=None):
+        self._client = client
+        self._cache = {}  # (endpoint, arguments) -> (time, response)
+        self._klines = {}  # (symbol, interval) -> (time, KlineBuffer, candles requested)
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from binance.client import Client
+                self._client = Client()  # Public endpoints need no credentials
+            return self._client
+
+    def call(self, name, **kwargs):
+        if name == 'get_klines' and set(kwargs) <= {'symbol', 'interval', 'limit'}:
+            return self.klines(**kwargs)
+        key = (name, tuple(sorted(kwargs.items())))
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            cached = self._cache.get(key)
+            if cached is not None and clock.time() - cached[0] < paper_market_ttl.get(name, book_ticker_ttl):
+                return cached[1]
+            response = getattr(self.client, name)(**kwargs)
+            self._cache[key] = (clock.time(), response)
+            return response
+
+    def klines(self, symbol, interval, limit=500):
+        # One series per symbol and interval serves every portfolio whatever limit it asks for. It
+        # grows when a larger limit is asked for, and is otherwise topped up with the candles opened
+        # since it was last refreshed
+        key = (symbol, interval)
+        with self._lock:
+            lock = self._locks.setdefault(('get_klines', symbol, interval), threading.Lock())
+        with lock:
+            fetched, series, depth = self._klines.get(key, (0, None, 0))
+            if limit > depth:
+                series = KlineBuffer(max(limit, candle_history))
+                series.extend(self.client.get_klines(symbol=symbol, interval=interval, limit=limit))
+                self._klines[key] = (clock.time(), series, limit)
+            elif clock.time() - fetched >= paper_market_ttl['get_klines']:
+                missing = limit
+                if len(series) and interval in interval_ms:
+                    missing = min(limit, (int(clock.time() * 1000) - series.last_open()) // interval_ms[interval] + 1)
+                series.extend(self.client.get_klines(symbol=symbol, interval=interval, limit=missing))
+                self._klines[key] = (clock.time(), series, depth)
+            return [series.row(i) for i in range(max(0, len(series) - limit), len(series))]
+
+# Stands in for binance.client.Client in a paper portfolio: public endpoints go to the shared
+# market data, account endpoints read the virtual balances and orders fill against the book
+class PaperClient:
+    public = {'get_klines', 'get_exchange_info', 'get_orderbook_tickers', 'get_order_book', 'get_all_tickers',
+              'get_ticker', 'get_symbol_ticker'}
+
+    def __init__(self, market, balances):
+        self.market = market
+        self.balances = dict(balances)
+        self.orders = {}
+        self._lock = threading.Lock()
+        self._order_id = 0
+
+    def __getattr__(self, name):
+        if name not in self.public:
+            raise AttributeError(name)
+
+        def call(**kwargs):
+            return self.market.call(name, **kwargs)
+        call.__name__ = name
+        return call
+
+    def get_asset_balance(self, asset):
+        with self._lock:
+            return {'asset': asset, 'free': str(self.balances.get(asset, 0.0)), 'locked': '0'}
+
+    def get_account(self):
+        with self._lock:
+            return {'balances': [{'asset': asset, 'free': str(free), 'locked': '0'} for asset, free in self.balances.items()]}
+
+    def get_open_orders(self):
+        return []
+
+    def get_trade_fee(self):
+        return {'tradeFee': [{'taker': paper_fee}]}
+
+    def order_market_sell(self, symbol, quantity, newClientOrderId=None, requests_params=None):
+        return self._fill(symbol, 'SELL', newClientOrderId, quantity=float(quantity))
+
+    def order_market_buy(self, symbol, quoteOrderQty, newClientOrderId=None, requests_params=None):
+        return self._fill(symbol, 'BUY', newClientOrderId, quote=float(quoteOrderQty))
+
+    def order_limit_sell(self, symbol, timeInForce, quantity, price, newClientOrderId=None, requests_params=None):
+        return self._fill(symbol, 'SELL', newClientOrderId, quantity=float(quantity), limit=float(price))
+
+    def order_limit_buy(self, symbol, timeInForce, quantity, price, newClientOrderId=None, requests_params=None):
+        return self._fill(symbol, 'BUY', newClientOrderId, quantity=float(quantity), limit=float(price))
+
+    def get_order(self, symbol, origClientOrderId):
+        with self._lock:
+            order = self.orders.get(origClientOrderId)
+        if order is None:
+            raise BinanceAPIException(None, 400, json.dumps({'code': -2013, 'msg': 'Order does not exist.'}))
+        return order
+
+    def _fill(self, symbol, side, client_order_id=None, quantity=None, quote=None, limit=None):
+        # Walks the book from the best level until the order is filled, the limit price is reached
+        # or the fetched depth runs out; whatever is left unfilled expires as with an IOC order
+        info = next(s for s in self.market.call('get_exchange_info')['symbols'] if s['symbol'] == symbol)
+        base, quote_asset = info['baseAsset'], info['quoteAsset']
+        book = self.market.call('get_order_book', symbol=symbol, limit=depth_limit)
+        executed, spent, fills = 0.0, 0.0, []
+        for price, available in ((float(p), float(q)) for p, q in book['bids' if side == 'SELL' else 'asks']):
+            if limit is not None and (price < limit if side == 'SELL' else price > limit):
+                break
+            qty = min(available, quantity - executed if quantity is not None else (quote - spent) / price)
+            if qty <= 0:
+                break
+            executed += qty
+            spent += qty * price
+            received, asset = (qty * price, quote_asset) if side == 'SELL' else (qty, base)
+            fills.append({'price': str(price), 'qty': str(qty), 'commission': str(received * paper_fee),
+                          'commissionAsset': asset})
+
+        paid, received = ((base, executed), (quote_asset, spent)) if side == 'SELL' else ((quote_asset, spent), (base, executed))
+        with self._lock:
+            if paid[1] > self.balances.get(paid[0], 0.0):
+                raise BinanceAPIException(None, 400, json.dumps(
+                    {'code': -2010, 'msg': 'Account has insufficient balance for requested action.'}))
+            self.balances[paid[0]] = self.balances.get(paid[0], 0.0) - paid[1]
+            self.balances[received[0]] = self.balances.get(received[0], 0.0) + received[1] * (1 - paper_fee)
+            self._order_id += 1
+            order_id = self._order_id
+
+        target = quantity if quantity is not None else quote
+        filled = (executed if quantity is not None else spent) >= target * (1 - 1e-9)
+        order = {'symbol': symbol, 'orderId': order_id, 'clientOrderId': client_order_id or f"paper-{order_id}",
+                 'transactTime': int(clock.time() * 1000), 'side': side, 'status': 'FILLED' if filled else 'EXPIRED',
+                 'executedQty': str(executed), 'cummulativeQuoteQty': str(spent)}
+        with self._lock:
+            self.orders[order['clientOrderId']] = order
+        return dict(order, fills=fills)
+
+# BinanceAPI over a PaperClient. Balances are always read from the virtual account, so no user
+# stream is opened, and candles come from the shared REST responses rather than a stream per portfolio
+class PaperBinanceAPI(BinanceAPI):
+    def __init__(self, market, balances, notifier=None):
+        super().__init__(PaperClient(market, balances), notifier)
+
+    def start_user_stream(self):
+        return None
+
+    def start_market_stream(self, symbols):
+        return None
+
+    def export_state(self):
+        state = super().export_state()
+        state['paper_balances'] = dict(self.client.balances)
+        return state
+
+    def load_state(self, state):
+        super().load_state(state)
+        if 'paper_balances' in state:
+            self.client.balances = dict(state['paper_balances'])
+
+# Sends a paper portfolio's notifications to the real chat, labelled with the portfolio name; the
+# chat id also names the portfolio's warm-state file
+class PaperNotifier:
+    def __init__(self, notifier, name):
+        self.notifier = notifier
+        self.name = name
+        self.chat_id = f"{notifier.chat_id}_paper_{name}"
+
+    def send_message(self, message, reply_markup=None):
+        self.notifier.send_message(f"[paper {self.name}] {message}", reply_markup)
+
+    def flush(self, timeout):
+        self.notifier.flush(timeout)
+
+def run_paper(path=paper_portfolios_file):
+    with open(path) as f:
+        portfolios = json.load(f)
+    modes = {'ast': start_ast, 'ast_plus': start_ast_plus, 'sst': start_sst, 'sst_plus': start_sst_plus}
+    updater.start_polling()  # Delivers inline-button confirmations for SST/SST+ portfolios
+
+    notifier = TelegramNotifier(updater.bot, telegram_chat_id)
+    market = SharedMarketData()
+    for portfolio in portfolios:
+        paper_notifier = PaperNotifier(notifier, portfolio['name'])
+        bot = TradingBot(PaperBinanceAPI(market, portfolio.get('balances', paper_starting_balances), paper_notifier),
+                         paper_notifier)
+        if 'rules' in portfolio:
+            bot.rules = RuleSet(portfolio['rules'])
+        mode = portfolio.get('mode', 'ast')
+        paper_notifier.send_message(f"Starting paper {mode.upper().replace('_PLUS', '+')} mode.")
+        start_in_background(modes[mode], bot)
+    shutdown.wait()  # signal_handler runs the graceful shutdown, which ends the process
+
+# Supervisor mode: one process polls Telegram and routes each chat to one of N worker processes by
+# consistent hashing, so a worker's loss only moves its own chats. Public market data is fetched once
+# by the supervisor and published to every worker over a local socket
+
+# Consistent hash ring mapping chat ids to worker ids
+class HashRing:
+    def __init__(self, replicas=hash_ring_replicas):
+        self.replicas = replicas
+        self._ring = []
+
+    def _hash(self, key):
+        return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            bisect.insort(self._ring, (self._hash(f"{node}:{i}"), node))
+
+    def remove(self, node):
+        self._ring = [entry for entry in self._ring if entry[1] != node]
+
+    def get(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._ring, (self._hash(key),)) % len(self._ring)
+        return self._ring[index][1]
+
+# Supervisor side: polls public market data once and pushes each snapshot to all connected workers
+class MarketDataHub:
+    def __init__(self, authkey, address=market_hub_address):
+        self.api = BinanceAPI.from_credentials(None, None)  # Public endpoints need no API key
+        self._listener = Listener(address, authkey=authkey)
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+        threading.Thread(target=self._publish, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            connection = self._listener.accept()
+            with self._lock:
+                self._connections.append(connection)
+            connection.send({'symbols': self.api.get_symbols()})
+
+    def _publish(self):
+        symbols_time = self.api._symbols_time
+        while True:
+            try:
+                snapshot = {'time': time.time(), 'prices': self.api.get_prices(), 'book_tops': self.api.get_book_tops()}
+                if self.api._symbols_time != symbols_time:
+                    snapshot['symbols'] = self.api.get_symbols()
+                    symbols_time = self.api._symbols_time
+                with self._lock:
+                    for connection in list(self._connections):
+                        try:
+                            connection.send(snapshot)
+                        except (OSError, EOFError):
+                            self._connections.remove(connection)
+            except Exception as e:
+                logging.error(f"Market data hub error: {e}")
+            time.sleep(book_ticker_ttl)
+
+# Worker side: receives the supervisor's market snapshots; BinanceAPI reads them instead of REST
+class MarketDataFeed:
+    def __init__(self, authkey, address=market_hub_address):
+        self.authkey = authkey
+        self.address = address
+        self.symbols = {}
+        self._snapshot = None
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def latest(self):
+        snapshot = self._snapshot
+        if snapshot is None or time.time() - snapshot['time'] > market_feed_max_age:
+            return None
+        return snapshot
 
+    def _run(self):
+        while True:
+            try:
+                connection = ConnectionClient(self.address, authkey=self.authkey)
+                while True:
+                    message = connection.recv()
+                    if 'symbols' in message:
+                        self.symbols = message['symbols']
+                    if 'prices' in message:
+                        self._snapshot = message
+            except (OSError, EOFError) as e:
+                logging.error(f"Market data feed disconnected: {e}")
+                time.sleep(1 + random.random())
+
+market_feed = None  # Set in worker processes started by the supervisor
+
+def worker_main(worker_id, updates, heartbeats, authkey):
+    global market_feed
+    market_feed = MarketDataFeed(authkey)
+    market_feed.start()
+    logging.info(f"Worker {worker_id} started")
     while True:
         try:
-            for i in range(len(coins)):
-                from_coin = coins[i]
-                to_coin = coins[(i + 1) % len(coins)]
-                if bot.binance_api.get_balance(from_coin) == 0:
-                    logging.info(f"No balance in {from_coin}. Skipping trading.")
-                    continue
-
-                symbol = f"{from_coin}{stable_coin}"
-                action = bot.trading_strategy(symbol)
-
-                if action == 'buy' or action == 'sell':
-                    logging.info(f"Suggested action: {action} for {symbol}. Waiting for user confirmation.")
-                    bot.notifier.send_message(f"Suggested action: {action} for {symbol}. Please confirm the trade.")
-                    user_input = input(f"Do you want to proceed with {action} {from_coin} -> {to_coin}? (yes/no): ")
-
-                    if user_input.lower() == 'yes':
-                        if bot.binance_api.execute_trade(from_coin, to_coin):
-                            purchase_prices[to_coin] = bot.binance_api.get_price(f"{to_coin}{stable_coin}")
-                    else:
-                        logging.info(f"User declined the trade for {symbol}.")
-                        bot.notifier.send_message(f"User declined the trade for {symbol}.")
-                else:
-                    logging.info(f"Holding {from_coin}. No trade signals.")
-
-            bot.rebalance_portfolio(target_allocation)
-            bot.stop_loss_check(purchase_prices)
-            bot.take_profit_check(purchase_prices)
-
-            time.sleep(60)
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-            bot.notifier.send_message(f"Trading bot encountered an unexpected error: {e}")
-            time.sleep(300)
-
-def start_sst_plus(bot):
-    purchase_prices = {coin: bot.binance_api.get_price(f"{coin}{stable_coin}") for coin in coins}
-    target_allocation = {
-        'BTC': 0.50,
-        'ETH': 0.30,
-    }
-
-    while True:
+            data = updates.get(timeout=worker_heartbeat_interval)
+        except queue.Empty:
+            data = None
+        heartbeats.put((worker_id, time.time()))
+        if data is not None:
+            dispatcher.process_update(telegram.Update.de_json(data, dispatcher.bot))
+
+class Supervisor:
+    def __init__(self, count=supervisor_workers):
+        self.count = count
+        self.authkey = os.urandom(16)
+        self.ring = HashRing()
+        self.workers = {}  # worker id -> (process, update queue)
+        self.last_seen = {}
+        self.chats = {}  # chat id -> worker id it was last routed to
+        # Spawned rather than forked so workers start from a clean module without the routing handler
+        self.context = multiprocessing.get_context('spawn')
+        self.heartbeats = self.context.Queue()
+        self._next_id = 0
+
+    def start_worker(self, worker_id=None):
+        # A replacement takes over the dead worker's id, and with it the same ring positions, so chats
+        # routed to healthy workers stay where they are
+        if worker_id is None:
+            worker_id = self._next_id
+            self._next_id += 1
+        updates = self.context.Queue()
+        process = self.context.Process(target=worker_main, args=(worker_id, updates, self.heartbeats, self.authkey),
+                                       daemon=True)
+        process.start()
+        self.workers[worker_id] = (process, updates)
+        self.last_seen[worker_id] = time.time()
+        self.ring.add(worker_id)
+
+    def route(self, update, context):
+        if update.effective_chat is None:
+            raise DispatcherHandlerStop()
+        chat_id = update.effective_chat.id
+        worker_id = self.ring.get(chat_id)
+        self.chats[chat_id] = worker_id
+        self.workers[worker_id][1].put(update.to_dict())
+        raise DispatcherHandlerStop()
+
+    def check_workers(self):
+        while not self.heartbeats.empty():
+            worker_id, seen = self.heartbeats.get()
+            self.last_seen[worker_id] = seen
+        for worker_id, (process, _) in list(self.workers.items()):
+            if process.is_alive() and time.time() - self.last_seen[worker_id] < worker_heartbeat_timeout:
+                continue
+            logging.error(f"Worker {worker_id} is unresponsive; restarting it")
+            process.terminate()
+            self.ring.remove(worker_id)
+            del self.workers[worker_id]
+            self.start_worker(worker_id)
+            for chat_id in [c for c, w in self.chats.items() if w == worker_id]:
+                del self.chats[chat_id]
+                updater.bot.send_message(chat_id=chat_id, text="Your session was restarted. "
+                                                               "Please send /start to resume trading.")
+
+    def run(self):
+        for _ in range(self.count):
+            self.start_worker()
+        MarketDataHub(self.authkey).start()
+        dispatcher.add_handler(TypeHandler(telegram.Update, self.route), group=-1)
+        updater.start_polling()
+        while True:
+            time.sleep(worker_heartbeat_interval)
+            self.check_workers()
+
+# Webhook mode: Telegram posts updates to a local HTTP server instead of being long-polled. Updates
+# are handed to the shared worker pool, one chat at a time so that each chat's updates run in the
+# order they arrived; a bounded number may be pending before new ones are refused
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if self.path != webhook_path or not hmac.compare_digest(secret, self.server.secret):
+            self._respond(403)
+            return
+        if not self.server.pending.acquire(blocking=False):
+            self._respond(429, {'Retry-After': '1'})
+            return
         try:
-            for i in range(len(coins)):
-                from_coin = coins[i]
-                to_coin = coins[(i + 1) % len(coins)]
-
-                if bot.binance_api.get_balance(from_coin) == 0:
-                    logging.info(f"No balance in {from_coin}. Skipping trading.")
-                    continue
-
-                symbol = f"{from_coin}{stable_coin}"
-                action = bot.trading_strategy(symbol)
-
-                if action == 'buy' or action == 'sell':
-                    data = {
-                        "symbol": symbol,
-                        "from_coin": from_coin,
-                        "to_coin": to_coin,
-                        "action": action,
-                        "balance": bot.binance_api.get_balance(from_coin),
-                        "price": bot.binance_api.get_price(symbol),
-                        "indicators": bot.calculate_indicators(bot.binance_api.get_historical_data(symbol)).iloc[-1].to_dict()
-                    }
-                    gpt_advice = ask_chatgpt_for_advice(data)
-
-                    logging.info(f"ChatGPT advice: {gpt_advice}")
-                    bot.notifier.send_message(f"ChatGPT advice for {from_coin} -> {to_coin}: {gpt_advice}")
-
-                    if gpt_advice.lower() == 'proceed':
-                        logging.info(f"Suggested action: {action} for {symbol}. Waiting for user confirmation.")
-                        bot.notifier.send_message(f"Suggested action: {action} for {symbol}. Please confirm the trade.")
-                        user_input = input(f"Do you want to proceed with {action} {from_coin} -> {to_coin}? (yes/no): ")
-
-                        if user_input.lower() == 'yes':
-                            if bot.binance_api.execute_trade(from_coin, to_coin):
-                                purchase_prices[to_coin] = bot.binance_api.get_price(f"{to_coin}{stable_coin}")
-                        else:
-                            logging.info(f"User declined the trade for {symbol}.")
-                            bot.notifier.send_message(f"User declined the trade for {symbol}.")
-                    else:
-                        logging.info(f"ChatGPT advised not to proceed with {action} action for {symbol}.")
-                        bot.notifier.send_message(f"ChatGPT advised not to proceed with {action} action for {symbol}.")
-                else:
-                    logging.info(f"Holding {from_coin}. No trade signals.")
-
-            bot.rebalance_portfolio(target_allocation)
-            bot.stop_loss_check(purchase_prices)
-            bot.take_profit_check(purchase_prices)
-
-            time.sleep(60)
-
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            self.server.pending.release()
+            self._respond(400)
+            return
+        if self.server.record is not None:
+            self.server.record.write(json.dumps(data) + '\n')
+        self.server.submit(data)
+        self._respond(200)
+
+    def _respond(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(f"Webhook {self.address_string()}: {format % args}")
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=webhook_listen, secret=webhook_secret, record_path=None):
+        super().__init__(address, WebhookHandler)
+        self.secret = secret
+        self.pending = threading.BoundedSemaphore(webhook_max_pending)
+        self.record = open(record_path, 'a', buffering=1) if record_path else None
+        self._chats = {}  # chat id -> updates waiting behind the one being handled
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def chat_of(data):
+        for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member',
+                     'chat_member', 'chat_join_request'):
+            if kind in data:
+                return data[kind].get('chat', {}).get('id')
+        return data.get('callback_query', {}).get('message', {}).get('chat', {}).get('id')
+
+    def submit(self, data):
+        # A chat with updates in flight gets the new one queued; otherwise a worker starts draining it
+        chat_id = self.chat_of(data)
+        if chat_id is None:
+            worker_pool.submit(self.dispatch, data)
+            return
+        with self._lock:
+            if chat_id in self._chats:
+                self._chats[chat_id].append(data)
+                return
+            self._chats[chat_id] = deque([data])
+        worker_pool.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id):
+        while True:
+            with self._lock:
+                updates = self._chats[chat_id]
+                if not updates:
+                    del self._chats[chat_id]
+                    return
+                data = updates.popleft()
+            self.dispatch(data)
+
+    def dispatch(self, data):
+        try:
+            dispatcher.process_update(telegram.Update.de_json(data, dispatcher.bot))
         except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-            bot.notifier.send_message(f"Trading bot encountered an unexpected error: {e}")
-            time.sleep(300)
+            logging.error(f"Failed to handle webhook update: {e}")
+        finally:
+            self.pending.release()
+
+def run_webhook(record_path=None):
+    server = WebhookServer(record_path=record_path)
+    updater.bot.set_webhook(url=webhook_url, api_kwargs={'secret_token': webhook_secret})
+    logging.info(f"Webhook server listening on {webhook_listen[0]}:{webhook_listen[1]}{webhook_path}")
+    server.serve_forever()
+
+def replay_updates(path, chats, url=None):
+    # Load test: posts recorded updates to a running webhook server, rewriting the chat id so that
+    # each update is repeated for every simulated chat, and reports throughput and status counts
+    url = url or f"http://127.0.0.1:{webhook_listen[1]}{webhook_path}"
+    with open(path) as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+
+    def post(chat_id, update):
+        data = json.loads(json.dumps(update))
+        message = data.get('message') or data.get('callback_query', {}).get('message') or {}
+        message.setdefault('chat', {})['id'] = chat_id
+        data.get('message', {}).setdefault('from', {})['id'] = chat_id
+        request = Request(url, data=json.dumps(data).encode(), method='POST', headers={
+            'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': webhook_secret})
+        try:
+            with urlopen(request, timeout=10) as response:
+                return response.status
+        except HTTPError as e:
+            return e.code
+        except URLError:
+            return 'unreachable'
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=64) as pool:
+        statuses = list(pool.map(lambda job: post(*job), ((1000000 + i, u) for i in range(chats) for u in recorded)))
+    elapsed = time.time() - started
+    counts = {status: statuses.count(status) for status in set(statuses)}
+    print(f"Replayed {len(statuses)} updates for {chats} chats in {elapsed:.2f}s "
+          f"({len(statuses) / elapsed:.0f}/s): {counts}")
 
 if __name__ == "__main__":
-    main()                
\ No newline at end of file
+    if '--record-market' in sys.argv:
+        recorder = MarketRecorder(sys.argv[sys.argv.index('--record-market') + 1])
+    if '--supervisor' in sys.argv:
+        Supervisor().run()
+    elif '--webhook' in sys.argv:
+        run_webhook(sys.argv[sys.argv.index('--record') + 1] if '--record' in sys.argv else None)
+    elif '--paper' in sys.argv:
+        arguments = sys.argv[sys.argv.index('--paper') + 1:]
+        run_paper(*arguments[:1])
+    elif '--replay-market' in sys.argv:
+        arguments = sys.argv[sys.argv.index('--replay-market') + 1:]
+        replay_market(arguments[0], None if arguments[1:2] == ['fast'] else float(arguments[1]) if len(arguments) > 1 else 1.0)
+    elif '--replay-updates' in sys.argv:
+        arguments = sys.argv[sys.argv.index('--replay-updates') + 1:]
+        replay_updates(arguments[0], int(arguments[1]) if len(arguments) > 1 else 1000)
+    else:
+        main()
\ No newline at end of file